@@ -2,11 +2,15 @@ import os
 import time
 import random
 import json
-import threading
 import datetime
 import sys
 import re
-from openai import OpenAI
+import argparse
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ultraman_engine import (AIEngine, Endpoint, LaneConsole, StageScheduler, backoff_delay, enter_lane, leave_lane,
+                             load_endpoints)
 
 # ==========================================
 #              1. 全局配置区
@@ -18,7 +22,8 @@ MODEL_POOL = [
     "gemini-3-pro-preview-high"
 ]
 TIMEOUT_SECONDS = 600
-client = None
+MAX_INFLIGHT_CALLS = 6
+engine = None
 
 # ==========================================
 #              2. 基础工具函数
@@ -38,16 +43,6 @@ def print_brand_end():
 def log(msg):
     print(f"[{datetime.datetime.now().strftime('%H:%M:%S')}] {msg}")
 
-def heartbeat(stop_event, task_name):
-    start_wait = time.time()
-    while not stop_event.is_set():
-        time.sleep(1)
-        elapsed = int(time.time() - start_wait)
-        if elapsed > 0 and elapsed % 2 == 0: 
-            spinner = ["|", "/", "-", "\\"][elapsed % 4]
-            sys.stdout.write(f"\r{spinner} [Pro级大脑思考中...] {task_name} 已进行 {elapsed} 秒...   ")
-            sys.stdout.flush()
-
 def cool_down_timer(seconds, reason="API冷却"):
     for i in range(seconds, 0, -1):
         sys.stdout.write(f"\r🧊 {reason}: {i}秒...   ")
@@ -67,39 +62,35 @@ def create_project_folder(book_title):
     if os.path.exists(target_name):
         timestamp = time.strftime("%Y%m%d_%H%M")
         target_name = f"Book_{timestamp}_{clean_title}"
-    if not os.path.exists(target_name):
-        os.makedirs(target_name)
-        os.makedirs(f"{target_name}/chapters")
+    # 同一分钟内同名 (批量开书时常见) 再追加序号，绝不复用别人的目录
+    base_name, suffix = target_name, 2
+    while os.path.exists(target_name):
+        target_name = f"{base_name}_{suffix}"
+        suffix += 1
+    os.makedirs(target_name)
+    os.makedirs(f"{target_name}/chapters")
     return target_name
 
-def call_ai_infinite(system_prompt, user_prompt, task_name="计算中"):
-    global client
+def call_ai_infinite(system_prompt, user_prompt, task_name="计算中", kind=None):
+    """死磕到出结果为止；kind 为调用类别 (同类调用共用一个 p95 自适应超时，不给就用固定超时)"""
     attempt = 0
     while True:
         attempt += 1
-        for model_name in MODEL_POOL:
-            stop_heartbeat = threading.Event()
-            t = threading.Thread(target=heartbeat, args=(stop_heartbeat, f"{task_name} (第{attempt}轮 | {model_name})"))
-            t.daemon = True
+        for model_name in engine.router.rank(MODEL_POOL):
             try:
-                t.start() 
-                response = client.chat.completions.create(
+                content = engine.chat(
                     model=model_name,
                     messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
-                    timeout=TIMEOUT_SECONDS
+                    timeout=TIMEOUT_SECONDS, label=f"{task_name} (第{attempt}轮 | {model_name})", kind=kind
                 )
-                stop_heartbeat.set()
-                if t.is_alive(): t.join()
                 sys.stdout.write("\r" + " " * 80 + "\r")
-                content = response.choices[0].message.content
                 if content: return content
             except Exception as e:
-                stop_heartbeat.set()
-                if t.is_alive(): t.join()
                 sys.stdout.write("\r" + " " * 80 + "\r")
                 continue 
-        log(f"🛑 暂时繁忙，冷却 20 秒后重试...")
-        cool_down_timer(20, "等待恢复")
+        wait = int(backoff_delay(attempt, base=20, cap=300))
+        log(f"🛑 暂时繁忙，冷却 {wait} 秒后重试...")
+        cool_down_timer(wait, "等待恢复")
 
 # 🔥 多行输入工具 (使用 # 号结束)
 def get_multiline_input(prompt_text):
@@ -121,56 +112,65 @@ def get_multiline_input(prompt_text):
 # ==========================================
 
 def init_client_dynamic():
-    global client
+    global engine
     print("\n🔐 --- 身份验证 ---")
     
     # 循环直到获取一个有效的 Client
     while True:
-        api_key = ""
-        base_url = ""
+        endpoints = []
+        multi = False
         
-        # 1. 尝试读取本地缓存
+        # 1. 尝试读取本地缓存 (支持多网关 "endpoints" 列表)
         if os.path.exists("config_key.json"):
             try:
                 with open("config_key.json", "r") as f:
                     cfg = json.load(f)
-                    api_key = cfg.get('api_key', "")
-                    base_url = cfg.get('base_url', "")
-                print(f"👀 检测到本地配置文件，正在尝试连接服务器...")
+                endpoints = load_endpoints(cfg)
+                multi = "endpoints" in cfg
+                print(f"👀 检测到本地配置文件 ({len(endpoints)} 个网关)，正在尝试连接服务器...")
             except:
                 print("⚠️ 配置文件格式错误，准备重新输入。")
         
         # 2. 如果没有缓存，或者缓存被删了，要求输入
-        if not api_key:
+        if not endpoints:
             api_key = input("请输入 API Key: ").strip()
             while not api_key: api_key = input("请输入 API Key: ").strip()
             
             default_url = "http://172.96.160.216:3000/v1"
             base_url = input(f"Base URL (回车默认 {default_url}): ").strip() or default_url
+            endpoints = [Endpoint(api_key, base_url)]
 
         # 3. 🔥 关键步骤：当场测试连接！
+        temp_engine = None
         try:
-            # 创建临时客户端
-            temp_client = OpenAI(api_key=api_key, base_url=base_url)
+            # 创建调度引擎 (Pro 级思考较慢，进度每 2 秒刷新一次)
+            temp_engine = AIEngine(endpoints, max_inflight=MAX_INFLIGHT_CALLS,
+                                   progress_interval=2, progress_title="Pro级大脑思考中...")
             
             # 发送一个极小的探测包 (列出模型) 来验证 Key 是否有效
             # 如果 Key 错误或网络不通，这里会直接报错，跳到 except
-            temp_client.models.list() 
+            temp_engine.list_models() 
             
             # 如果没报错，说明连接成功！
-            client = temp_client
+            engine = temp_engine
             print("✅ 验证成功！连接已建立。")
             
-            # 保存正确的配置
-            with open("config_key.json", "w") as f:
-                json.dump({"api_key": api_key, "base_url": base_url}, f)
+            # 保存正确的配置 (多网关配置是手写的，原样保留)
+            if not multi:
+                with open("config_key.json", "w") as f:
+                    json.dump({"api_key": endpoints[0].api_key, "base_url": endpoints[0].base_url}, f)
             
             # 退出循环，进入主程序
             return 
             
         except Exception as e:
+            if temp_engine: temp_engine.close()
             print(f"\n❌ 连接失败: {str(e)[:100]}...")
             print("⚠️ 警告：当前的 API Key 或 URL 无效！")
+            if multi:
+                # 手写的多网关配置不自动删除，免得一个 Key 失效就把整份配置丢了
+                print("🛑 config_key.json 中所有网关均不可用，请检查后重新运行。")
+                sys.exit(1)
             
             # 🔥 自动删除错误的配置文件，确保下次循环不会再读它
             if os.path.exists("config_key.json"):
@@ -201,12 +201,12 @@ def consult_chief_editor(tag, user_input):
     """
     
     try:
-        response = client.chat.completions.create(
+        content = engine.chat(
             model="gemini-3-pro-preview", 
             messages=[{"role": "user", "content": prompt}],
-            timeout=60
+            timeout=60, label="总编定调", kind="side"
         )
-        content = response.choices[0].message.content.replace("```json", "").replace("```", "").strip()
+        content = content.replace("```json", "").replace("```", "").strip()
         json_str = re.search(r'\{.*\}', content, re.DOTALL).group(0)
         data = json.loads(json_str)
         print(f"📋 总编定调：{data['cheat_level']} | 禁区：{data['forbidden_elements']}")
@@ -236,7 +236,7 @@ def polish_killer_title(draft_title, draft_logline, tag, config_data):
     请生成 1 个最好的书名，**只输出书名，不要书名号**。
     """
     try:
-        new_title = call_ai_infinite(prompt, "请给出一个最炸裂的书名。", task_name="标题优化")
+        new_title = call_ai_infinite(prompt, "请给出一个最炸裂的书名。", task_name="标题优化", kind="title")
         clean_title = new_title.replace("《", "").replace("》", "").replace("书名：", "").strip()
         print(f"✨ 标题整形成功：{draft_title}  --->  {clean_title}")
         return clean_title
@@ -273,7 +273,7 @@ def generate_art_prompt(folder_path, title, logline, tag, config_data):
     """
     
     try:
-        res = call_ai_infinite(prompt, "请生成封面提示词", task_name="封面设计")
+        res = call_ai_infinite(prompt, "请生成封面提示词", task_name="封面设计", kind="cover")
         content = res.replace("```json", "").replace("```", "").strip()
         match = re.search(r'\{.*\}', content, re.DOTALL)
         if match:
@@ -333,7 +333,7 @@ def agent0_meeting(tag, user_input, round_num, config_data):
     JSON: {{ "title": "草拟书名", "logline": "一句话梗概", "highlight": "核心卖点" }}
     """
     
-    res = call_ai_infinite(system_prompt, f"请针对标签“{tag}”进行策划。", task_name=f"第{round_num}场脑暴")
+    res = call_ai_infinite(system_prompt, f"请针对标签“{tag}”进行策划。", task_name=f"第{round_num}场脑暴", kind="brainstorm")
     if res:
         try:
             clean_res = res.replace("```json", "").replace("```", "").strip()
@@ -362,99 +362,308 @@ def agent1_macro_structure_volumes(idea_summary, total_words, config_data):
     
     输出格式要求：清晰的分卷列表。
     """
-    return call_ai_infinite(prompt, "请输出分卷宏观大纲。", task_name="分卷规划")
-
-def agent2_outline_detailed_volumes(macro_structure, total_chapters):
-    print(f"\n🧱 正在填充 {total_chapters} 章的详细细纲 (分卷填充)...")
+    return call_ai_infinite(prompt, "请输出分卷宏观大纲。", task_name="分卷规划", kind="macro")
+
+OUTLINE_META = "outline_meta.json"
+OUTLINE_BATCH = 60      # 每次请求最多写多少章细纲 (一次要太多会被模型输出上限截断)
+VOLUME_HEADING = re.compile(r'^[\s#*>\-【\[]*第[一二三四五六七八九十百零\d]+卷')
+
+def save_outline_file(path, text):
+    """先写临时文件再改名，写作机读到的细纲永远是完整的 (后缀不用 .tmp，免得被写作机启动对账清掉)"""
+    tmp_path = path + ".writing"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush(); os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def update_outline_meta(folder_path, **fields):
+    """📜 outline_meta.json：细纲生成进度 (status=streaming/complete, ready=已就绪章数)，写作机据此边等边写"""
+    meta_path = f"{folder_path}/{OUTLINE_META}"
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f: meta = json.load(f)
+    except Exception: meta = {}
+    meta.update(fields, updated=time.time())
+    save_outline_file(meta_path, json.dumps(meta, ensure_ascii=False, indent=1))
+
+def split_volumes(macro_structure, total_chapters):
+    """✂️ 把分卷大纲切成各卷 [(卷名, 本卷大纲原文, 章数)]，章数按大纲里的预估值按比例凑满总章数"""
+    volumes, current = [], None
+    for line in macro_structure.split("\n"):
+        if VOLUME_HEADING.match(line):
+            current = [line.strip(" #*>-"), []]
+            volumes.append(current)
+        elif current: current[1].append(line)
+    if not volumes: volumes = [["全书", macro_structure.split("\n")]]
+
+    estimates = []
+    for name, body in volumes:
+        text = "\n".join([name] + body)
+        match = re.search(r'(?:预估)?章节数[^\d\n]{0,6}(\d+)', text) or re.search(r'(\d+)\s*章', text)
+        estimates.append(int(match.group(1)) if match and int(match.group(1)) > 0 else 1)
+    # 按预估比例分配，最大余数法补齐，每卷至少 1 章
+    scale = total_chapters / sum(estimates)
+    counts = [max(1, int(e * scale)) for e in estimates]
+    by_remainder = sorted(range(len(counts)), key=lambda i: estimates[i] * scale - counts[i], reverse=True)
+    for i in itertools.islice(itertools.cycle(by_remainder), max(0, total_chapters - sum(counts))): counts[i] += 1
+    return [(name, "\n".join(body).strip(), n) for (name, body), n in zip(volumes, counts)]
+
+def agent2_outline_batch(macro_structure, volume_name, volume_text, first, last, recent_lines):
+    """🧱 只写全书第 first~last 章的细纲 (同属一卷)，返回逐章列表"""
     prompt = f"""
-    你是一位主编。请根据【分卷宏观大纲】生成全书细纲。
-    【分卷大纲】：
+    你是一位主编。请根据【分卷宏观大纲】为【{volume_name}】生成分章细纲。
+    【全书分卷大纲】：
     {macro_structure}
     
+    【本卷大纲】：
+    {volume_text}
+    
+    【上文最后几章细纲】：
+    {chr(10).join(recent_lines) or "无 (全书开篇)"}
+    
     【任务要求】：
-    1. 总共生成约 {total_chapters} 章。
-    2. **严格按照分卷节奏**。
+    1. 只写全书第 {first} 章到第 {last} 章，共 {last - first + 1} 章，紧接上文。
+    2. **严格按照本卷节奏**。
     3. **每章要有钩子**。
     4. **输出格式**：
        纯文本列表，每一行只写一章。
        不要写"第一卷"这种大标题，直接输出章节列表。
     """
-    return call_ai_infinite(prompt, "开始生成全书细纲。", task_name="生成细纲")
+    res = call_ai_infinite(prompt, f"开始生成第{first}-{last}章细纲。", task_name=f"细纲 {first}-{last}章", kind="outline")
+    lines = [line.strip() for line in res.replace("```", "").split("\n") if line.strip()]
+    return [line for line in lines if not VOLUME_HEADING.match(line)][:last - first + 1]
+
+def stream_outline(folder_path, macro_structure, total_chapters):
+    """🌊 分卷分批生成细纲，每批写完立刻追加进 outline.txt，写作机不必等全书细纲"""
+    volumes = split_volumes(macro_structure, total_chapters)
+    plan, start = [], 1
+    for name, _, count in volumes:
+        plan.append({"name": name, "start": start, "end": start + count - 1, "status": "pending"})
+        start += count
+    print(f"\n🧱 正在填充 {total_chapters} 章的详细细纲 (分 {len(volumes)} 卷流式生成)...")
+    update_outline_meta(folder_path, status="streaming", total_chapters=total_chapters, ready=0, volumes=plan)
+
+    outline_path = f"{folder_path}/outline.txt"
+    lines = []
+    for (name, volume_text, count), volume in zip(volumes, plan):
+        volume["start"], volume_end = len(lines) + 1, len(lines) + count
+        misses = 0
+        while len(lines) < volume_end and misses < 3:
+            first = len(lines) + 1
+            last = min(volume_end, first + OUTLINE_BATCH - 1)
+            batch = agent2_outline_batch(macro_structure, name, volume_text, first, last, lines[-5:])
+            if not batch: misses += 1; continue
+            lines.extend(batch)
+            save_outline_file(outline_path, "\n".join(lines))
+            update_outline_meta(folder_path, ready=len(lines))
+            print(f"   📜 {name}：细纲已就绪至第 {len(lines)} 章" + (" (现在就可以启动写作机开写了)" if first == 1 else ""))
+        volume["end"], volume["status"] = len(lines), "done"
+        update_outline_meta(folder_path, volumes=plan)
+
+    update_outline_meta(folder_path, status="complete", ready=len(lines), total_chapters=len(lines))
+    return "\n".join(lines)
 
 # ==========================================
 #              7. 主程序入口
 # ==========================================
 
-def start_new_project():
-    print_brand_header()
-    
-    # 🔥 1. 带验证的初始化
-    init_client_dynamic()
-    
-    tag = input("\n📝 1. 题材标签 (如 宫斗/谍战/玄幻): ").strip() or "玄幻"
-    
-    # 🔥 2. 灵感录入 (带 # 号结束符)
-    user_input = get_multiline_input("\n💡 2. 灵感片段录入")
-    
-    # 🔥 3. 询问字数目标
-    word_count_input = input("\n📏 3. 目标字数 (万字, 默认30): ").strip()
-    total_words = int(word_count_input) * 10000 if word_count_input.isdigit() else 300000
-    total_chapters = int(total_words / 2500)
-    print(f"   ⚙️  目标设定: {total_words} 字 | 约 {total_chapters} 章")
-
-    # 1. 总编定调
-    config_data = consult_chief_editor(tag, user_input)
-    
-    # 2. 脑暴
-    candidates = []
-    print(f"\n🧠 正在进行合规化脑暴...")
-    
-    while len(candidates) < 3:
-        idx = len(candidates) + 1
-        idea = agent0_meeting(tag, user_input, idx, config_data)
-        if idea:
-            candidates.append(idea)
-            print(f"✅ 方案[{idx}]《{idea['title']}》\n   🔥 {idea['logline'][:50]}...")
+PICK_POLICIES = ("first", "highlight", "random")
+BRAINSTORM_TARGET = 3       # 供挑选的方案数
+BRAINSTORM_SPARES = 2       # 冗余并发的备用脑暴场次
+BATCH_CONCURRENCY = 4
+FOLDER_LOCK = threading.Lock()
 
+def interactive_pick(candidates):
     print("\n🏆 --- 请选择最佳创意 ---")
     for i, cand in enumerate(candidates):
         print(f"[{i+1}] 《{cand['title']}》\n    📝 {cand['logline']}\n")
     
-    idx = -1
     while True:
         choice = input("👉 请输入序号 (1-3): ").strip()
         if choice.isdigit() and 1 <= int(choice) <= len(candidates):
-            idx = int(choice) - 1
             print(f"✅ 你选择了方案 [{choice}]")
-            break
+            return int(choice) - 1
         else:
             print("❌ 输入无效！请输入 1、2 或 3，不要直接回车。")
-            
-    final_idea_obj = candidates[idx]
-    
-    # 3. 标题整形
-    killer_title = polish_killer_title(final_idea_obj['title'], final_idea_obj['logline'], tag, config_data)
-    final_idea_obj['title'] = killer_title 
-    
-    # 4. 创建文件夹
-    folder_path = create_project_folder(final_idea_obj['title'])
-    print(f"\n📂 项目文件夹已创建: {folder_path}")
+
+def pick_candidate(candidates, policy, tag):
+    """🗳️ 批量模式按策略自动选方案：first=第一个，random=随机，highlight=让总编按核心卖点评审"""
+    if policy == "first" or len(candidates) == 1: return 0
+    if policy == "random": return random.randrange(len(candidates))
+    listing = "\n".join(f"[{i+1}] 《{c['title']}》 梗概：{c['logline']} | 卖点：{c.get('highlight', '')}"
+                        for i, c in enumerate(candidates))
+    prompt = f"""
+    你是一位资深的网文总编。以下是题材“{tag}”的几个新书方案：
+    {listing}
     
-    final_idea_str = f"书名：《{final_idea_obj['title']}》\n梗概：{final_idea_obj['logline']}\n卖点：{final_idea_obj['highlight']}"
-    with open(f"{folder_path}/idea.txt", "w", encoding="utf-8") as f: f.write(final_idea_str)
+    请只看【核心卖点】的新鲜度和爆款潜力，选出最好的一个。只输出序号数字。
+    """
+    try:
+        res = engine.chat(
+            model="gemini-3-pro-preview",
+            messages=[{"role": "user", "content": prompt}],
+            timeout=60, label="卖点评审", kind="side"
+        )
+        choice = int(re.search(r'\d+', res).group(0)) - 1
+        if 0 <= choice < len(candidates): return choice
+    except Exception: pass
+    print("⚠️ 卖点评审未给出有效序号，默认选第一个方案。")
+    return 0
+
+def save_text(path, text):
+    with open(path, "w", encoding="utf-8") as f: f.write(text)
+    return text
+
+def plan_project(tag, user_input, total_words, pick="interactive"):
+    """🏛️ 从总编定调到细纲、封面的完整策划流程 (交互和批量共用)，返回项目文件夹
+
+    按依赖图并发执行：定调 -> 多场脑暴并发 (冗余开场，先到先得) -> 选方案/标题/建目录 ->
+    分卷规划 -> 细纲 (分卷流式落盘)；封面只依赖书名和梗概，与分卷、细纲同时进行。
+    """
+    total_chapters = int(total_words / 2500)
+    print(f"   ⚙️  目标设定: {total_words} 字 | 约 {total_chapters} 章")
+    stages = StageScheduler(max_workers=BRAINSTORM_TARGET + BRAINSTORM_SPARES)
+    try:
+        # 1. 总编定调
+        config_data = consult_chief_editor(tag, user_input)
+
+        # 2. 脑暴 (并发，多开几场兜底 JSON 解析失败)
+        print(f"\n🧠 正在进行合规化脑暴 ({BRAINSTORM_TARGET} 场 + 备用 {BRAINSTORM_SPARES} 场并发)...")
+        rounds = itertools.count(1)
+        brainstorm = lambda: stages.submit(agent0_meeting, tag, user_input, next(rounds), config_data)
+        openers = [brainstorm() for _ in range(BRAINSTORM_TARGET + BRAINSTORM_SPARES)]
+        candidates = stages.first_results(openers, BRAINSTORM_TARGET, spawn=brainstorm)
+        for i, idea in enumerate(candidates, 1):
+            print(f"✅ 方案[{i}]《{idea['title']}》\n   🔥 {idea['logline'][:50]}...")
+
+        if pick == "interactive":
+            idx = interactive_pick(candidates)
+        else:
+            idx = pick_candidate(candidates, pick, tag)
+            print(f"🗳️ 按策略 [{pick}] 选定方案 [{idx + 1}]《{candidates[idx]['title']}》")
+                
+        final_idea_obj = candidates[idx]
+        
+        # 3. 标题整形
+        killer_title = polish_killer_title(final_idea_obj['title'], final_idea_obj['logline'], tag, config_data)
+        final_idea_obj['title'] = killer_title 
+        
+        # 4. 创建文件夹 (批量并发时防止两个项目抢同一个目录名)
+        with FOLDER_LOCK:
+            folder_path = create_project_folder(final_idea_obj['title'])
+            update_outline_meta(folder_path, status="streaming", total_chapters=total_chapters, ready=0)
+        print(f"\n📂 项目文件夹已创建: {folder_path}")
+        
+        final_idea_str = f"书名：《{final_idea_obj['title']}》\n梗概：{final_idea_obj['logline']}\n卖点：{final_idea_obj['highlight']}"
+        save_text(f"{folder_path}/idea.txt", final_idea_str)
+        
+        # 🔥 5. 宏观规划 (分卷) -> 🔥 6. 细纲填充 (分卷流式写入，写作机可以边等边写)
+        macro = stages.submit(lambda: save_text(f"{folder_path}/bible.txt",
+                                                agent1_macro_structure_volumes(final_idea_str, total_words, config_data)))
+        outline = stages.submit(lambda macro: stream_outline(folder_path, macro, total_chapters), after={"macro": macro})
+        
+        # 🔥 7. 生成封面提示词 (与 5、6 并行)
+        art = stages.submit(generate_art_prompt, folder_path, killer_title, final_idea_obj['logline'], tag, config_data)
+        for future in (macro, outline, art): future.result()
+    except BaseException:
+        stages.close(wait=False)
+        raise
+    stages.close()
+    return folder_path
+
+def start_new_project():
+    print_brand_header()
     
-    # 🔥 5. 宏观规划 (分卷)
-    macro = agent1_macro_structure_volumes(final_idea_str, total_words, config_data)
-    with open(f"{folder_path}/bible.txt", "w", encoding="utf-8") as f: f.write(macro)
+    # 🔥 1. 带验证的初始化
+    init_client_dynamic()
     
-    # 🔥 6. 细纲填充
-    outline = agent2_outline_detailed_volumes(macro, total_chapters)
-    with open(f"{folder_path}/outline.txt", "w", encoding="utf-8") as f: f.write(outline)
+    tag = input("\n📝 1. 题材标签 (如 宫斗/谍战/玄幻): ").strip() or "玄幻"
     
-    # 🔥 7. 生成封面提示词
-    generate_art_prompt(folder_path, killer_title, final_idea_obj['logline'], tag, config_data)
+    # 🔥 2. 灵感录入 (带 # 号结束符)
+    user_input = get_multiline_input("\n💡 2. 灵感片段录入")
     
+    # 🔥 3. 询问字数目标
+    word_count_input = input("\n📏 3. 目标字数 (万字, 默认30): ").strip()
+    total_words = int(word_count_input) * 10000 if word_count_input.isdigit() else 300000
+
+    plan_project(tag, user_input, total_words)
     print_brand_end()
 
+# ---------- 📦 批量开书 (JSONL 规格文件，无人值守) ----------
+
+def load_batch_specs(path):
+    """每行一个项目：{"tag": "玄幻", "inspiration": "...", "words": 30, "pick": "highlight"}
+    words 单位为万字 (默认 30)；pick 为 first / highlight / random (默认 highlight)"""
+    specs = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip(): continue
+            try:
+                raw = json.loads(line)
+                spec = {
+                    "tag": str(raw.get("tag") or "玄幻").strip(),
+                    "inspiration": str(raw.get("inspiration") or "").strip(),
+                    "words": int(raw.get("words") or 30) * 10000,
+                    "pick": raw.get("pick") or "highlight",
+                }
+                if spec["pick"] not in PICK_POLICIES: raise ValueError(f"pick 只能是 {'/'.join(PICK_POLICIES)}")
+                specs.append(spec)
+            except Exception as e:
+                print(f"⚠️ 第 {line_no} 行规格无效，已跳过: {e}")
+    return specs
+
+def plan_from_spec(index, spec):
+    enter_lane(f"策划{index}·{spec['tag']}")
+    try:
+        return plan_project(spec["tag"], spec["inspiration"], spec["words"], pick=spec["pick"])
+    finally:
+        leave_lane()
+
+def run_batch(spec_path, concurrency=BATCH_CONCURRENCY):
+    print_brand_header()
+    specs = load_batch_specs(spec_path)
+    if not specs: print("❌ 规格文件里没有有效项目。"); return
+    if not os.path.exists("config_key.json"):
+        print("❌ 批量模式不能交互输入 Key，请先运行一次交互模式或准备好 config_key.json。"); return
+    init_client_dynamic()
+
+    log(f"📦 批量开书：{len(specs)} 个项目 | 同时策划 {concurrency} 个")
+    sys.stdout = LaneConsole(sys.stdout)
+    results = []
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        futures = [pool.submit(plan_from_spec, i, spec) for i, spec in enumerate(specs, 1)]
+        for i, future in enumerate(futures, 1):
+            try: results.append((i, future.result(), None))
+            except KeyboardInterrupt: raise
+            except Exception as e: results.append((i, None, e))
+    except KeyboardInterrupt:
+        # 一次 Ctrl-C 就停：先掐断在途请求 (正在策划的项目随之报错退出)，排队的项目直接丢弃
+        engine.cancel_all()
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+    print("\n📦 批量开书结果：")
+    for i, folder_path, error in results:
+        print(f"   [{i}] ✅ {folder_path}" if folder_path else f"   [{i}] ❌ 失败: {str(error)[:80]}")
+    print_brand_end()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="奥特曼众神殿 (策划机)")
+    parser.add_argument("--batch", metavar="SPECS.jsonl", default=None,
+                        help="批量开书：按 JSONL 规格文件无人值守地并发策划多本书")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY,
+                        help=f"批量模式同时策划的项目数 (默认 {BATCH_CONCURRENCY})")
+    parser.add_argument("--max-inflight", type=int, default=MAX_INFLIGHT_CALLS,
+                        help=f"全局同时在途的 AI 请求上限 (默认 {MAX_INFLIGHT_CALLS})")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    start_new_project()
\ No newline at end of file
+    args = parse_args()
+    MAX_INFLIGHT_CALLS = max(1, args.max_inflight)
+    try:
+        if args.batch: run_batch(args.batch, max(1, args.concurrency))
+        else: start_new_project()
+    except KeyboardInterrupt:
+        print("\n👋 用户手动停止")
+        if engine: engine.cancel_all()
@@ -5,7 +5,16 @@ import datetime
 import threading
 import json
 import re
-from openai import OpenAI
+import argparse
+import collections
+import hashlib
+import socket
+import sqlite3
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from ultraman_engine import (AIEngine, Endpoint, LaneConsole, StageScheduler, StreamInterrupted, backoff_delay,
+                             current_lane, enter_lane, leave_lane, load_endpoints, local_state_path)
+from library_index import LibraryIndex
 
 # ==========================================
 #              1. 全局配置区
@@ -42,16 +51,47 @@ ULTIMATE_POOL = [
 ]
 
 TIMEOUT_SECONDS = 1200 
-client = None
-START_WORK_TIME = time.time()
-SESSION_START_TIME = time.time() 
-CHAPTERS_WRITTEN_SESSION = 0 
+MIN_CHAPTER_CHARS = 1500
+# ✂️ 短稿续写：不足 MIN_CHAPTER_CHARS 但超过 MIN_DRAFT_CHARS 的稿子保留下来接着写，最多续 MAX_CONTINUATION_ROUNDS 轮
+MIN_DRAFT_CHARS = 300
+MAX_CONTINUATION_ROUNDS = 3
+# 断点稿/中断稿字数够了但停在半句时，先续写一轮收尾再采用
+SENTENCE_ENDINGS = "。！？…」』”）!?.~—"
+# 🌊 流式写作：边收边落盘 .partial；超过 STALL_TIMEOUT_SECONDS 秒没有新字就换模型
+STREAM_MODE = False
+STALL_TIMEOUT_SECONDS = 90
+# 🏇 高潮章对冲：None=关闭；N=首个 Pro 模型 N 秒未交稿就追加第二个 Pro 模型 (0=同时发)
+HEDGE_DELAY_SECONDS = None
+engine = None
+
+# 🔥 多书并行：全局 API 并发闸门 (所有书共享，防止把网关打爆)
+MAX_INFLIGHT_CALLS = 8
+MAX_INFLIGHT_PER_MODEL = 4
+# 🗃️ Flash 副任务 (反转/摘要/拟题/资产审计) 响应缓存：重跑同样的输入不再花 API 调用
+USE_RESPONSE_CACHE = True
+# 🧬 合并后处理：标题 + 摘要 + 档案 一次 Flash 请求 (校验失败自动退回三次独立调用)
+FUSED_POSTPROCESS = False
+# 🎒 每章上下文 (档案 + 设定 + 分层前情) 的固定预算 (估算 token)，第 1 章和第 2000 章一样大
+CONTEXT_TOKEN_BUDGET = 6000
+# 🧵 分卷并行：各卷同时开写，后面的卷用推演的交接状态开篇，写完后修整接缝
+VOLUME_PARALLEL = False
+# 🔎 全库检索索引 (本机 ~/.cache/ultraman/library_*.db)：每章落盘后增量登记，5_search_library.py 毫秒级查询
+LIBRARY_INDEX = True
+# 🚦 跨进程限流：同一台机器上所有写手进程共享的每分钟请求配额
+ENDPOINT_RPM = 60
+MODEL_RPM = 30
+# 📜 流式细纲：策划机分卷写细纲时，写作机追上进度就每 OUTLINE_POLL_SECONDS 秒看一次；超过 OUTLINE_STALE_SECONDS 没动静视为策划中断
+OUTLINE_POLL_SECONDS = 15
+OUTLINE_STALE_SECONDS = 1800
+STOP_EVENT = threading.Event()
+CLAIM_LOCK = threading.Lock()
 
 # ==========================================
 #              2. 基础工具函数
 # ==========================================
 
 def set_terminal_title(title):
+    if current_lane(): return  # 并行模式下各书不抢终端标题
     sys.stdout.write(f"\x1b]2;{title}\x07")
     sys.stdout.flush()
 
@@ -78,19 +118,10 @@ def get_progress_bar(current, total, length=20):
     bar = "▓" * filled_length + "░" * (length - filled_length)
     return f"[{bar}] {int(percent * 100)}%"
 
-def calculate_book_stats(folder_path, total_chapters):
-    finished_chapters = 0
-    finished_words = 0
-    for i in range(1, total_chapters + 1):
-        file_path = f"{folder_path}/chapters/第{i}章.txt"
-        if os.path.exists(file_path):
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    if len(content) > 100: 
-                        finished_chapters += 1
-                        finished_words += len(content)
-            except: pass 
+def calculate_book_stats(manifest, total_chapters):
+    """看板统计直接取清单里的累计值，O(1)"""
+    finished_chapters = manifest.finished_chapters
+    finished_words = manifest.finished_words
     remaining_chapters = total_chapters - finished_chapters
     # 动态估算剩余字数
     avg_len = int(finished_words / finished_chapters) if finished_chapters > 0 else 2500
@@ -98,7 +129,7 @@ def calculate_book_stats(folder_path, total_chapters):
     return finished_chapters, finished_words, remaining_chapters, estimated_remaining_words
 
 def print_final_statistics(folder_path, total_chapters):
-    finished_chapters, finished_words, _, _ = calculate_book_stats(folder_path, total_chapters)
+    finished_chapters, finished_words, _, _ = calculate_book_stats(BookManifest(folder_path), total_chapters)
     avg_words = int(finished_words / finished_chapters) if finished_chapters > 0 else 0
     print("\n" + "="*50)
     print("🏆 【奥特曼·完本战绩结算】 🏆")
@@ -109,37 +140,204 @@ def print_final_statistics(folder_path, total_chapters):
     print(f"📊 平均每章: {avg_words} 字")
     print("="*50 + "\n")
 
-def calculate_eta(total_chapters, current_chapter_index):
-    global SESSION_START_TIME, CHAPTERS_WRITTEN_SESSION
+def calculate_eta(total_chapters, current_chapter_index, session_start, chapters_written):
     chapters_remaining = total_chapters - current_chapter_index
-    if CHAPTERS_WRITTEN_SESSION == 0:
+    if chapters_written == 0:
         return f"计算中..."
-    elapsed_session = time.time() - SESSION_START_TIME
-    avg_time_per_chapter = elapsed_session / CHAPTERS_WRITTEN_SESSION
+    elapsed_session = time.time() - session_start
+    avg_time_per_chapter = elapsed_session / chapters_written
     eta_seconds = int(avg_time_per_chapter * chapters_remaining)
     m, s = divmod(eta_seconds, 60)
     h, m = divmod(m, 60)
     return f"{h}小时{m}分" if h > 0 else f"{m}分{s}秒"
 
-def heartbeat(stop_event, subtitle=""):
-    start_wait = time.time()
-    while not stop_event.is_set():
-        time.sleep(1)
-        elapsed = int(time.time() - start_wait)
-        if elapsed > 0 and elapsed % 15 == 0:
-            sys.stdout.write(f"\r⏳ [奥特曼充能中...] AI已思考 {elapsed} 秒... ({subtitle})   ")
-            sys.stdout.flush()
-
 def read_file(path):
     if not os.path.exists(path): return None
     with open(path, "r", encoding="utf-8") as f: return f.read()
 
-def is_locked(folder_path): return os.path.exists(os.path.join(folder_path, "writing.lock"))
+def atomic_write(path, text):
+    """先写临时文件并 fsync 再改名：崩溃时磁盘上要么是旧文件、要么是完整的新文件，不会出现半截"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush(); os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_tail(path, chars=500):
+    """只读文件末尾 (seek)，不把整章读进内存"""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - chars * 4))  # UTF-8 每字最多 4 字节
+        return f.read().decode("utf-8", errors="ignore")[-chars:]
+
+# ---------- 📜 流式细纲 (outline_meta.json：策划机分卷生成细纲的进度) ----------
+
+def load_outline(folder_path):
+    """返回 (已就绪的各章细纲, 细纲元信息)；没有 outline_meta.json 的老书视为细纲已完整"""
+    outlines = [line.strip() for line in (read_file(f"{folder_path}/outline.txt") or "").split('\n') if line.strip()]
+    try:
+        with open(f"{folder_path}/outline_meta.json", "r", encoding="utf-8") as f: meta = json.load(f)
+    except Exception: meta = {"status": "complete"}
+    if meta.get("status") != "complete": outlines = outlines[:int(meta.get("ready", 0))]
+    return outlines, meta
+
+def outline_complete(meta): return meta.get("status") == "complete"
+
+def planned_chapters(outlines, meta):
+    """细纲生成完之前，总章数用策划时的计划值"""
+    return len(outlines) if outline_complete(meta) else max(len(outlines), int(meta.get("total_chapters", 0)))
+
+def book_volumes(folder_path):
+    """策划时记下的分卷范围 [(卷序号, 卷名, 起始章, 结束章)]；老书没有分卷信息返回 []"""
+    _, meta = load_outline(folder_path)
+    try: return [(k, v.get("name") or f"第{k}卷", int(v["start"]), int(v["end"])) for k, v in enumerate(meta.get("volumes") or [], 1)]
+    except (KeyError, TypeError, ValueError): return []
+
+def outline_stalled(meta):
+    """细纲还在生成，但超过 OUTLINE_STALE_SECONDS 没有进展 (策划机多半已中断)"""
+    return not outline_complete(meta) and time.time() - meta.get("updated", 0) > OUTLINE_STALE_SECONDS
+
+def outline_ready(folder_path, chapter_num=1):
+    """设定集和第 chapter_num 章细纲都已就绪 (细纲已完整时超出范围也算就绪，交给写作流程收尾)"""
+    if not os.path.exists(f"{folder_path}/bible.txt"): return False
+    outlines, meta = load_outline(folder_path)
+    return bool(outlines) and (len(outlines) >= chapter_num or outline_complete(meta))
+
+def wait_for_outline(folder_path, chapter_num):
+    """⏳ 写作追上了细纲进度：等第 chapter_num 章细纲生成 (或细纲收尾)。停止信号 / 租约丢失 / 策划中断时返回 None"""
+    log(f"⏳ 第 {chapter_num} 章细纲还在生成中，等待策划机...")
+    while True:
+        outlines, meta = load_outline(folder_path)
+        if len(outlines) >= chapter_num or outline_complete(meta): return outlines, meta
+        if outline_stalled(meta):
+            log(f"🛑 细纲超过 {OUTLINE_STALE_SECONDS // 60} 分钟没有进展，策划机可能已中断，本书暂停。"); return None
+        if lease_lost(folder_path) or STOP_EVENT.wait(OUTLINE_POLL_SECONDS): return None
+
+# ---------- 🔐 租约锁 (writing.lock：持有者 + 心跳，过期可被任何工位安全接管) ----------
+
+LEASE_SECONDS = 120     # 心跳超过这么久没更新，视为持有者已崩溃
+HEARTBEAT_SECONDS = 30
+HOST_NAME = socket.gethostname()
+HELD_LEASES = {}        # 书籍目录 -> 本进程的租约令牌
+LOST_LEASES = set()     # 被别人接管的书，写作循环看到后立即停笔
+LEASE_LOCK = threading.Lock()
+
+def lock_path_of(folder_path): return os.path.join(folder_path, "writing.lock")
+
+def read_lease(folder_path):
+    """返回租约 dict；旧版 "LOCKED" 锁以文件修改时间当心跳；没有锁返回 None"""
+    path = lock_path_of(folder_path)
+    try:
+        with open(path, "r", encoding="utf-8") as f: raw = f.read()
+        mtime = os.path.getmtime(path)
+    except OSError: return None
+    try:
+        lease = json.loads(raw)
+        if isinstance(lease, dict) and "heartbeat" in lease: return lease
+    except ValueError: pass
+    return {"token": None, "host": "?", "pid": "?", "started": mtime, "heartbeat": mtime, "legacy": True}
+
+def lease_age(lease): return time.time() - lease["heartbeat"]
+def lease_expired(lease): return lease_age(lease) > LEASE_SECONDS
+
+def is_locked(folder_path):
+    lease = read_lease(folder_path)
+    return lease is not None and not lease_expired(lease)
+
+def _create_lease(folder_path):
+    """O_EXCL 原子创建：同一时刻只有一个工位 (跨主机共享目录同样适用) 能创建成功"""
+    token = uuid.uuid4().hex
+    now = time.time()
+    lease = {"token": token, "host": HOST_NAME, "pid": os.getpid(), "started": now, "heartbeat": now}
+    try:
+        fd = os.open(lock_path_of(folder_path), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError: return None
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(lease, f)
+        f.flush(); os.fsync(f.fileno())
+    return token
+
+def _evict_stale_lease(folder_path, stale):
+    """把过期的锁改名挪走 (改名是原子的，多个工位同时抢只有一个能挪走)；挪走后发现其实刚续过约就还回去"""
+    grave = f"{lock_path_of(folder_path)}.stale.{uuid.uuid4().hex[:8]}"
+    try: os.rename(lock_path_of(folder_path), grave)
+    except OSError: return
+    try:
+        with open(grave, "r", encoding="utf-8") as f: moved = json.loads(f.read())
+    except (OSError, ValueError): moved = None
+    if isinstance(moved, dict) and "heartbeat" in moved and not lease_expired(moved):
+        try: os.link(grave, lock_path_of(folder_path))  # 持有者刚续约，原样放回 (link 不会覆盖已存在的锁)
+        except OSError: pass
+    try: os.remove(grave)
+    except OSError: pass
+
 def lock_book(folder_path):
-    with open(os.path.join(folder_path, "writing.lock"), "w") as f: f.write("LOCKED")
-def unlock_book(folder_path):
-    lock_path = os.path.join(folder_path, "writing.lock")
-    if os.path.exists(lock_path): os.remove(lock_path)
+    """抢占书籍租约，成功返回 True；锁被别人持有且未过期返回 False"""
+    token = _create_lease(folder_path)
+    if token is None:
+        stale = read_lease(folder_path)
+        if stale is None or not lease_expired(stale): return False
+        who = "旧版锁" if stale.get("legacy") else f"{stale['host']} PID {stale['pid']}"
+        print(f"🔓 {folder_path} 的写作锁已过期 ({who}，{int(lease_age(stale))} 秒无心跳)，尝试接管...")
+        _evict_stale_lease(folder_path, stale)
+        token = _create_lease(folder_path)
+        if token is None: return False
+    with LEASE_LOCK:
+        HELD_LEASES[folder_path] = token
+        LOST_LEASES.discard(folder_path)
+    _ensure_heartbeat()
+    return True
+
+def unlock_book(folder_path, force=False):
+    """只删除自己持有的锁；force=True 时无条件删除 (人工强制接管)"""
+    with LEASE_LOCK: token = HELD_LEASES.pop(folder_path, None)
+    lease = read_lease(folder_path)
+    if lease is None: return
+    if force or (token and lease.get("token") == token):
+        try: os.remove(lock_path_of(folder_path))
+        except OSError: pass
+
+def lease_lost(folder_path):
+    return folder_path in LOST_LEASES
+
+def _renew_leases():
+    with LEASE_LOCK: held = dict(HELD_LEASES)
+    for folder_path, token in held.items():
+        lease = read_lease(folder_path)
+        if lease is None or lease.get("token") != token:
+            with LEASE_LOCK:
+                if HELD_LEASES.get(folder_path) != token: continue
+                HELD_LEASES.pop(folder_path, None)
+                LOST_LEASES.add(folder_path)
+            print(f"\n⚠️ {folder_path} 的写作锁已被其它工位接管，本工位停止写这本书。")
+            continue
+        lease["heartbeat"] = time.time()
+        tmp_path = f"{lock_path_of(folder_path)}.{token}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f: json.dump(lease, f)
+            os.replace(tmp_path, lock_path_of(folder_path))
+        except OSError: pass
+
+def _heartbeat_loop():
+    while True:
+        time.sleep(HEARTBEAT_SECONDS)
+        try: _renew_leases()
+        except Exception: pass
+
+_HEARTBEAT = []
+def _ensure_heartbeat():
+    with LEASE_LOCK:
+        if _HEARTBEAT: return
+        t = threading.Thread(target=_heartbeat_loop, daemon=True)
+        t.start()
+        _HEARTBEAT.append(t)
+
+def describe_lock(folder_path):
+    lease = read_lease(folder_path)
+    if lease is None: return "🟢 空闲"
+    if lease_expired(lease): return f"🟡 锁已过期 ({int(lease_age(lease))} 秒无心跳，可自动接管)"
+    if lease.get("legacy"): return "🔴 锁定中 (旧版锁)"
+    return f"🔴 锁定中 ({lease['host']} PID {lease['pid']}，{int(lease_age(lease))} 秒前心跳)"
 
 def mark_book_as_finished(folder_path, total_chapters):
     try:
@@ -152,6 +350,7 @@ def mark_book_as_finished(folder_path, total_chapters):
         new_full_path = os.path.join(dir_name, new_folder_name)
         os.rename(folder_path, new_full_path)
         print(f"🎉 文件夹已自动封存为: {new_folder_name}")
+        sync_library()
     except Exception as e:
         print(f"\n⚠️ 完结改名失败: {e}")
 
@@ -197,32 +396,231 @@ def rollback_latest_chapter(folder_path):
             print(f"⏪ [时光倒流] 已删除最近一章: {max_file} (将执行重写)")
         except: pass
 
+# ---------- 🧾 写作日志 (journal.jsonl：每章哪些阶段已经落盘) ----------
+
+JOURNAL_LOCK = threading.Lock()
+
+def record_stage(folder_path, chapter_num, stage, **extra):
+    """追加一条阶段记录并 fsync (text=正文已落盘，assets=档案已审计，baseline=旧书基线)"""
+    rec = {"chapter": chapter_num, "stage": stage, "time": int(time.time()), **extra}
+    with JOURNAL_LOCK:
+        with open(os.path.join(folder_path, "journal.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            f.flush(); os.fsync(f.fileno())
+
+def load_journal(folder_path):
+    """{章节号: {阶段: 最后一条记录}}；没有日志文件返回 None (旧书)"""
+    path = os.path.join(folder_path, "journal.jsonl")
+    if not os.path.exists(path): return None
+    journal = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+                journal.setdefault(rec["chapter"], {})[rec["stage"]] = rec
+            except: pass  # 半行 (写入时崩溃) 直接忽略
+    return journal
+
+def recover_book(folder_path):
+    """🩹 启动对账：正文是原子写入的，文件在就是完整的，不再无条件删最新一章。
+    只做两件事：档案跑到了正文前面就回滚到对应快照；正文完整但档案没审计的章节补做审计。"""
+    for d in (folder_path, os.path.join(folder_path, "chapters"), os.path.join(folder_path, "assets_snapshots")):
+        if not os.path.isdir(d): continue
+        for name in os.listdir(d):
+            if name.endswith(".tmp"): os.remove(os.path.join(d, name))  # 没来得及改名的半成品
+
+    journal = load_journal(folder_path)
+    manifest = BookManifest(folder_path)
+    if journal is None and manifest.chapters:
+        # 旧书：以前的写入不是原子的，最后一章可能是半截，按老规矩回档一次，之后记基线
+        rollback_latest_chapter(folder_path)
+        manifest = BookManifest(folder_path)
+        written = [n for n, e in manifest.chapters.items() if e["size"] > 100]
+        record_stage(folder_path, max(written, default=0), "baseline")
+        journal = load_journal(folder_path)
+    journal = journal or {}
+    init_assets_file(folder_path)
+
+    written = sorted(n for n, e in manifest.chapters.items() if e["size"] > 100)
+    last_written = written[-1] if written else 0
+    baseline = max((n for n, stages in journal.items() if "baseline" in stages), default=0)
+
+    # 1. 档案比正文新 (审计先于正文落盘后崩溃)：回滚到最近一份不晚于已写章节的快照
+    ledger = load_ledger(folder_path)
+    if ledger and ledger["chapter"] > last_written:
+        for n in range(last_written, -1, -1):
+            snapshot = load_ledger_at(folder_path, n)
+            if snapshot: break
+        else: snapshot = initial_ledger()
+        for name in os.listdir(os.path.join(folder_path, "assets_snapshots")):
+            if name.endswith(".json") and name[:-5].isdigit() and int(name[:-5]) > snapshot["chapter"]:
+                os.remove(os.path.join(folder_path, "assets_snapshots", name))
+        save_ledger(folder_path, snapshot, rewind=True)
+        print(f"⏪ [档案回滚] 档案停在第 {ledger['chapter']} 章，正文只到第 {last_written} 章，已回滚到第 {snapshot['chapter']} 章快照。")
+        ledger = snapshot
+
+    # 2. 正文完整但档案没跟上：按章补做审计 (同一份正文审计过就不再重复，哪怕当时失败)
+    for n in written:
+        if n <= baseline: continue
+        body = chapter_body(read_file(manifest.chapter_path(n)))
+        audit = journal.get(n, {}).get("assets")
+        if audit and audit.get("hash") == content_hash(body): continue
+        log(f"🩹 第 {n} 章正文完整但档案未审计，补做资产审计 (无需重写正文)...")
+        update_assets(folder_path, n, body)
+
+    # 3. 实体索引同理 (只管建索引以后写的章节)
+    since = load_entities(folder_path)["since"]
+    for n in written:
+        if since is None or n < since or n <= baseline: continue
+        body = chapter_body(read_file(manifest.chapter_path(n)))
+        indexed = journal.get(n, {}).get("entities")
+        if indexed and indexed.get("hash") == content_hash(body): continue
+        log(f"🩹 第 {n} 章实体索引缺失，补建...")
+        update_entities(folder_path, n, body)
+
+
 # ==========================================
 #              4. 档案与审计系统
 # ==========================================
 
+# ---------- 📂 结构化档案 (assets.json 为准，assets.txt 只是渲染出来给人/模型看的视图) ----------
+
+ASSET_SECTIONS = [("panel", "基础面板"), ("resources", "核心资产"), ("relationships", "人际关系"), ("status", "状态栏")]
+TIMELINE_IN_VIEW = 5    # 档案/快照里只带最近几条时间线，完整时间线追加在 timeline.jsonl，快照不随章数膨胀
+
+def initial_ledger():
+    return {
+        "chapter": 0,
+        "panel": {"姓名": "(待定)", "境界": "凡人", "当前位置": "新手村"},
+        "resources": {"灵石/金币": "0", "关键道具": "无"},
+        "relationships": {"仇敌": "无", "盟友": "无"},
+        "status": {"身体状况": "健康"},
+        "timeline": [],
+    }
+
+def parse_legacy_assets(text):
+    """旧书的自由文本 assets.txt -> 结构化档案 (按【小节】和 "- 键：值" 尽量还原)"""
+    ledger = initial_ledger()
+    for section in ("panel", "resources", "relationships", "status"): ledger[section] = {}
+    names = {title: key for key, title in ASSET_SECTIONS}
+    section = "panel"
+    for line in text.splitlines():
+        line = line.strip().lstrip("#").strip()
+        header = re.match(r'^[【\[](.+?)[】\]]', line)
+        if header:
+            title = header.group(1)
+            section = "timeline" if "时间" in title else next((k for t, k in names.items() if t in title or title in t), section)
+            continue
+        item = line.lstrip("-*• ").strip()
+        if not item: continue
+        if section == "timeline":
+            ledger["timeline"].append({"chapter": None, "event": item}); continue
+        parts = re.split(r'[：:]', item, maxsplit=1)
+        if len(parts) == 2: ledger[section][parts[0].strip()] = parts[1].strip()
+        else: ledger[section][item] = ""
+    return ledger
+
+def render_assets(ledger):
+    lines = []
+    for key, title in ASSET_SECTIONS:
+        lines.append(f"【{title}】")
+        lines += [f"- {k}：{v}" for k, v in ledger[key].items()] or ["- 无"]
+        lines.append("")
+    recent = ledger["timeline"][-TIMELINE_IN_VIEW:]
+    if recent:
+        lines.append("【近期时间线】")
+        lines += [f"- 第{e['chapter']}章：{e['event']}" if e.get("chapter") else f"- {e['event']}" for e in recent]
+    return "\n".join(lines).strip()
+
+def write_json(path, data):
+    atomic_write(path, json.dumps(data, ensure_ascii=False, indent=1))
+
+def snapshot_path(folder_path, chapter_num):
+    return os.path.join(folder_path, "assets_snapshots", f"{chapter_num}.json")
+
+def load_ledger(folder_path):
+    try:
+        with open(f"{folder_path}/assets.json", "r", encoding="utf-8") as f: return json.load(f)
+    except: return None
+
+def load_ledger_at(folder_path, chapter_num):
+    """第 N 章写完时的档案 (直接读快照，O(1))；0 表示开书时的状态"""
+    try:
+        with open(snapshot_path(folder_path, chapter_num), "r", encoding="utf-8") as f: return json.load(f)
+    except: return None
+
+def handoff_path(folder_path, chapter_num):
+    return os.path.join(folder_path, "handoffs", f"{chapter_num}.json")
+
+def load_handoff(folder_path, chapter_num):
+    """分卷并行时第 chapter_num 章 (某卷开头) 的交接状态：{"summary", "ledger"}；没有返回 None"""
+    try:
+        with open(handoff_path(folder_path, chapter_num), "r", encoding="utf-8") as f: return json.load(f)
+    except: return None
+
+def ledger_before(folder_path, chapter_num):
+    """写第 N 章前的档案：往前找最近一份快照，碰到分卷交接点就用交接状态 (各卷各自成链)"""
+    for n in range(chapter_num - 1, -1, -1):
+        snapshot = load_ledger_at(folder_path, n)
+        if snapshot: return snapshot
+        handoff = load_handoff(folder_path, n + 1)
+        if handoff: return handoff["ledger"]
+    return load_ledger(folder_path) or initial_ledger()
+
+LEDGER_LOCK = threading.Lock()
+
+def append_timeline(folder_path, chapter_num, events):
+    """完整时间线只追加不重写：每行 {"chapter", "events"}，同一章重复审计时以最后一行为准"""
+    if not events: return
+    with LEDGER_LOCK:
+        with open(os.path.join(folder_path, "timeline.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps({"chapter": chapter_num, "events": events}, ensure_ascii=False) + "\n")
+            f.flush(); os.fsync(f.fileno())
+
+def save_ledger(folder_path, ledger, rewind=False):
+    """落盘本章快照；assets.json / assets.txt 只跟着写得最远的一章走 (分卷并行时各卷交错提交)，rewind=True 用于回滚"""
+    os.makedirs(os.path.join(folder_path, "assets_snapshots"), exist_ok=True)
+    write_json(snapshot_path(folder_path, ledger["chapter"]), ledger)
+    if not rewind:
+        append_timeline(folder_path, ledger["chapter"],
+                        [e["event"] for e in ledger["timeline"] if e.get("chapter") == ledger["chapter"]])
+    with LEDGER_LOCK:
+        latest = load_ledger(folder_path)
+        if latest and latest["chapter"] > ledger["chapter"] and not rewind: return
+        write_json(f"{folder_path}/assets.json", ledger)
+        atomic_write(f"{folder_path}/assets.txt", render_assets(ledger))
+
+def migrate_timeline(folder_path, ledger):
+    """早期的 assets.json 带完整时间线：搬进 timeline.jsonl，档案只留最近几条"""
+    events = ledger["timeline"]
+    groups = []
+    for e in events:
+        if groups and groups[-1][0] == e.get("chapter"): groups[-1][1].append(e["event"])
+        else: groups.append((e.get("chapter"), [e["event"]]))
+    for chapter_num, group in groups: append_timeline(folder_path, chapter_num, group)
+    ledger["timeline"] = events[-TIMELINE_IN_VIEW:]
+    save_ledger(folder_path, ledger, rewind=True)
+    print(f"📂 已将 {len(events)} 条时间线移入 timeline.jsonl")
+
 def init_assets_file(folder_path):
-    assets_path = f"{folder_path}/assets.txt"
-    if not os.path.exists(assets_path):
-        initial_state = """
-【基础面板】
-- 姓名：(待定)
-- 境界：凡人
-- 当前位置：新手村
-
-【核心资产】
-- 灵石/金币：0
-- 关键道具：无
-
-【人际关系】
-- 仇敌：无
-- 盟友：无
-
-【状态栏】
-- 身体状况：健康
-"""
-        with open(assets_path, "w", encoding="utf-8") as f:
-            f.write(initial_state.strip())
+    ledger = load_ledger(folder_path)
+    if ledger:
+        if len(ledger["timeline"]) > TIMELINE_IN_VIEW and not os.path.exists(f"{folder_path}/timeline.jsonl"):
+            migrate_timeline(folder_path, ledger)
+        return
+    legacy = read_file(f"{folder_path}/assets.txt")
+    ledger = initial_ledger()
+    if legacy:
+        # 旧档案记录的是已写到的最新一章的状态
+        ledger = parse_legacy_assets(legacy)
+        chapters_dir = os.path.join(folder_path, "chapters")
+        nums = [int(m.group(1)) for m in (re.search(r'第(\d+)章\.txt$', f) for f in os.listdir(chapters_dir)) if m] if os.path.isdir(chapters_dir) else []
+        ledger["chapter"] = max(nums, default=0)
+        print(f"📂 已将旧版 assets.txt 转换为结构化档案 assets.json (对应第 {ledger['chapter']} 章)")
+        if ledger["timeline"]:
+            append_timeline(folder_path, None, [e["event"] for e in ledger["timeline"]])
+            ledger["timeline"] = ledger["timeline"][-TIMELINE_IN_VIEW:]
+    save_ledger(folder_path, ledger)
 
 def extract_money_value(text):
     try:
@@ -231,36 +629,520 @@ def extract_money_value(text):
     except: pass
     return "?"
 
-def update_assets(folder_path, chapter_content):
-    assets_path = f"{folder_path}/assets.txt"
-    current_assets = read_file(assets_path) or "无"
-    old_val = extract_money_value(current_assets)
+def validate_assets_delta(delta):
+    """变更格式：{"panel": {键: 新值或 null}, ..., "timeline": ["本章大事", ...]}；不合格返回 None"""
+    if not isinstance(delta, dict): return None
+    clean = {}
+    for key, _ in ASSET_SECTIONS:
+        changes = delta.get(key) or {}
+        if not isinstance(changes, dict): return None
+        clean[key] = {str(k): (None if v is None else str(v)) for k, v in changes.items()}
+    events = delta.get("timeline") or []
+    if isinstance(events, str): events = [events]
+    if not isinstance(events, list): return None
+    clean["timeline"] = [str(e) for e in events if str(e).strip()]
+    return clean
+
+def apply_assets_delta(ledger, delta, chapter_num):
+    new = json.loads(json.dumps(ledger))
+    for key, _ in ASSET_SECTIONS:
+        for k, v in delta[key].items():
+            if v is None: new[key].pop(k, None)
+            else: new[key][k] = v
+    new["timeline"] = (new["timeline"] + [{"chapter": chapter_num, "event": e} for e in delta["timeline"]])[-TIMELINE_IN_VIEW:]
+    new["chapter"] = chapter_num
+    return new
+
+ASSETS_DELTA_FORMAT = """{"panel": {"境界": "筑基"}, "resources": {"灵石/金币": "120", "破损的剑": null}, "relationships": {"盟友": "李四"}, "status": {}, "timeline": ["拜入青云宗"]}"""
+
+def assets_prompt_view(ledger):
+    """发给审计模型的档案：不带时间线，只带当前各栏位"""
+    return json.dumps({key: ledger[key] for key, _ in ASSET_SECTIONS}, ensure_ascii=False)
+
+def parse_json_object(raw):
+    raw = raw.replace("```json", "").replace("```", "").strip()
+    return json.loads(re.search(r'\{.*\}', raw, re.DOTALL).group(0))
+
+def update_assets(folder_path, chapter_num, chapter_content):
+    ledger = ledger_before(folder_path, chapter_num)  # 以上一章快照为底，重复审计同一章也不会叠加变更
     
     prompt = f"""
     你是一位严谨的小说档案管理员。
-    【上一章档案】：{current_assets}
+    【当前档案】：{assets_prompt_view(ledger)}
     【最新章节】：{chapter_content[-4000:]} 
-    【任务】：更新面板、资产、人际、状态、时间线。
-    【输出格式】：直接输出更新后的完整档案，保持原有Markdown格式。
+    【任务】：找出本章带来的面板、资产、人际、状态变化，以及本章的时间线大事。
+    【输出格式】：只输出变更的 JSON 对象，没变的栏位不要写；值为 null 表示删除该条目。例如：
+    {ASSETS_DELTA_FORMAT}
     """
     
     try:
         # 审计用Flash
-        response = client.chat.completions.create(
+        raw = engine.chat(
             model="gemini-3-flash-preview", 
             messages=[{"role": "user", "content": prompt}],
-            timeout=60
+            timeout=60, label="资产审计", cache=USE_RESPONSE_CACHE, kind="side"
         )
-        new_assets = response.choices[0].message.content
-        with open(assets_path, "w", encoding="utf-8") as f:
-            f.write(new_assets)
-        new_val = extract_money_value(new_assets)
-        if old_val != new_val:
-            print(f"\n    💰 [账本审计] 资金变化: {old_val} -> {new_val}")
-        else:
-            print(f"\n    📝 [档案更新] 剧情档案已同步。")
-        return True
-    except: return False
+        delta = validate_assets_delta(parse_json_object(raw))
+        if delta is not None: commit_assets(folder_path, ledger, delta, chapter_num)
+        ok = delta is not None
+    except KeyboardInterrupt: raise
+    except: ok = False
+    record_stage(folder_path, chapter_num, "assets", hash=content_hash(chapter_content), ok=ok)
+    return ok
+
+def commit_assets(folder_path, ledger, delta, chapter_num):
+    old_val = extract_money_value(render_assets(ledger))
+    new_ledger = apply_assets_delta(ledger, delta, chapter_num)
+    save_ledger(folder_path, new_ledger)
+    new_val = extract_money_value(render_assets(new_ledger))
+    if old_val != new_val:
+        print(f"\n    💰 [账本审计] 资金变化: {old_val} -> {new_val}")
+    else:
+        print(f"\n    📝 [档案更新] 剧情档案已同步。")
+
+
+# ---------- 📒 章节清单 (manifest.json，增量维护，不再每章全量重扫) ----------
+
+def chapter_body(text):
+    """去掉 "第 N 章 标题" 头，只保留正文 (标题可能被修复工具改写，不参与哈希)"""
+    if text.startswith("第 ") and "\n\n" in text: return text.split("\n\n", 1)[1]
+    return text
+
+def content_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class BookManifest:
+    """每章一条记录：{size, chars, mtime, hash}，hash 为正文 (去掉章节头) 的 SHA-1
+
+    打开时按文件大小/修改时间对账一次 (只 stat，不重读未变化的章节)，
+    之后每写完一章 record() 一次，累计字数/章数随之增量更新。
+    """
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.path = os.path.join(folder_path, "manifest.json")
+        self.lock = threading.RLock()  # 分卷并行时多个卷共用一份清单
+        self.chapters = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.chapters = {int(k): v for k, v in json.load(f).get("chapters", {}).items()}
+        except: pass
+        self._reconcile()
+
+    def chapter_path(self, chapter_num):
+        return os.path.join(self.folder_path, "chapters", f"第{chapter_num}章.txt")
+
+    def _reconcile(self):
+        chapters_dir = os.path.join(self.folder_path, "chapters")
+        on_disk = {}
+        if os.path.isdir(chapters_dir):
+            for f in os.listdir(chapters_dir):
+                match = re.fullmatch(r'第(\d+)章\.txt', f)
+                if match: on_disk[int(match.group(1))] = os.stat(os.path.join(chapters_dir, f))
+        changed = set(self.chapters) - set(on_disk)
+        for num in changed: del self.chapters[num]
+        for num, st in on_disk.items():
+            entry = self.chapters.get(num)
+            if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime: continue
+            self._update(num, read_file(self.chapter_path(num)) or "")
+            changed.add(num)
+        self._totals()
+        if changed: self.save()
+
+    def _update(self, chapter_num, text):
+        st = os.stat(self.chapter_path(chapter_num))
+        self.chapters[chapter_num] = {
+            "size": st.st_size, "chars": len(text), "mtime": st.st_mtime,
+            "hash": content_hash(chapter_body(text)),
+        }
+
+    def _totals(self):
+        done = [e["chars"] for e in self.chapters.values() if e["chars"] > 100]
+        self.finished_chapters = len(done)
+        self.finished_words = sum(done)
+
+    def get(self, chapter_num):
+        return self.chapters.get(chapter_num)
+
+    def record(self, chapter_num, text):
+        """章节文件写完后调用一次"""
+        with self.lock:
+            old = self.chapters.get(chapter_num)
+            if old and old["chars"] > 100:
+                self.finished_chapters -= 1; self.finished_words -= old["chars"]
+            self._update(chapter_num, text)
+            if len(text) > 100:
+                self.finished_chapters += 1; self.finished_words += len(text)
+            self.save()
+        index_in_library(self.folder_path, chapter_num)
+
+    def save(self):
+        with self.lock:
+            atomic_write(self.path, json.dumps({"chapters": self.chapters}, ensure_ascii=False))
+
+def index_in_library(folder_path, chapter_num):
+    """🔎 全库检索索引跟着每章落盘增量登记 (登记失败不影响写书，检索机查询前会自己补)"""
+    if not LIBRARY_INDEX: return
+    try: LibraryIndex().index_chapter(folder_path, chapter_num)
+    except Exception as e: log(f"⚠️ 全库索引登记第 {chapter_num} 章失败: {e}")
+
+def sync_library():
+    """书籍改名 (完结封存) 后同步一次，索引里的书名跟着改，不用重建"""
+    if not LIBRARY_INDEX: return
+    try: LibraryIndex().sync()
+    except Exception as e: log(f"⚠️ 全库索引同步失败: {e}")
+
+
+# ---------- 📚 章节摘要库 (summaries.jsonl，断点续写不丢前情) ----------
+
+SUMMARY_FAILED = "（摘要生成失败）"
+SUMMARY_LOCK = threading.Lock()
+
+def load_summaries(folder_path):
+    """读取摘要库：{章节号: {"hash": ..., "summary": ...}}，同一章以最后一条为准"""
+    summaries = {}
+    path = os.path.join(folder_path, "summaries.jsonl")
+    if not os.path.exists(path): return summaries
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+                summaries[rec["chapter"]] = rec
+            except: pass  # 半行 (写入时崩溃) 直接忽略
+    return summaries
+
+def save_summary(folder_path, chapter_num, body, summary):
+    if not summary or summary == SUMMARY_FAILED: return
+    rec = {"chapter": chapter_num, "hash": content_hash(body), "summary": summary}
+    with SUMMARY_LOCK:
+        with open(os.path.join(folder_path, "summaries.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+def lookup_summary(summaries, chapter_num, body_hash):
+    """只有正文哈希一致的摘要才可信 (章节被重写过就作废)"""
+    rec = summaries.get(chapter_num)
+    if rec and rec.get("hash") == body_hash: return rec["summary"]
+    return None
+
+# ---------- 🗂️ 实体索引 (entities.json：人物/地点/物品/势力 -> 首末出场、别名、设定卡) ----------
+
+ENTITY_KINDS = ("人物", "地点", "物品", "势力")
+MAX_ENTITY_CARDS = 12       # 每章最多带几张设定卡
+ENTITY_LOCK = threading.Lock()
+
+class EntityMatcher:
+    """🔎 Aho-Corasick 多模式匹配：一遍扫描找出文本里出现的全部实体名/别名，耗时只和文本长度、命中数有关。
+    重叠的命中按“最左最长”取舍：“张三丰”不会顺带算一次“张三”，“青云宗”不会算成“青云”"""
+    def __init__(self, patterns):
+        """patterns：{名字或别名: 规范名}"""
+        self.goto, self.fail, self.out = [{}], [0], [[]]
+        for pattern, canonical in patterns.items():
+            node = 0
+            for ch in pattern:
+                if ch not in self.goto[node]:
+                    self.goto[node][ch] = len(self.goto)
+                    self.goto.append({}); self.fail.append(0); self.out.append([])
+                node = self.goto[node][ch]
+            self.out[node].append((len(pattern), canonical))
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]: f = self.fail[f]
+                self.fail[child] = self.goto[f].get(ch, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def find(self, text):
+        """{规范名: 出现次数}，按首次出现的先后排列"""
+        node, matches = 0, []
+        for end, ch in enumerate(text, 1):
+            while node and ch not in self.goto[node]: node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            matches.extend((end - length, -length, name) for length, name in self.out[node])
+        # 最左最长：从左往右取，每处取最长的那个，被它盖住的短命中丢掉
+        hits, covered = {}, 0
+        for start, neg_length, name in sorted(matches):
+            if start < covered: continue
+            hits[name] = hits.get(name, 0) + 1
+            covered = start - neg_length
+        return hits
+
+def load_entities(folder_path):
+    """since = 建索引时的第一章 (之前写的章节不补建)"""
+    try:
+        with open(f"{folder_path}/entities.json", "r", encoding="utf-8") as f: return json.load(f)
+    except: return {"since": None, "entities": {}}
+
+def entity_matcher(index):
+    """单字名太容易误中，不参与匹配"""
+    patterns = {}
+    for name, entity in index["entities"].items():
+        for alias in [name] + entity.get("aliases", []):
+            if len(alias) >= 2: patterns.setdefault(alias, name)
+    return EntityMatcher(patterns)
+
+def merge_entity(index, item, chapter_num):
+    """把模型登记的一条实体并入索引 (名字撞上已有别名的并到原条目)"""
+    if not isinstance(item, dict) or not isinstance(item.get("name"), str): return
+    name = item["name"].strip()
+    if len(name) < 2: return
+    aliases = [str(a).strip() for a in item.get("aliases") or [] if str(a).strip() and str(a).strip() != name]
+    owner = next((n for n, e in index["entities"].items() if name == n or name in e.get("aliases", [])), None)
+    entity = index["entities"].setdefault(owner or name, {
+        "kind": item.get("kind") if item.get("kind") in ENTITY_KINDS else "其他",
+        "aliases": [], "first": chapter_num, "last": chapter_num, "card": "",
+    })
+    if owner and owner != name: aliases.append(name)
+    entity["aliases"] = list(dict.fromkeys(entity["aliases"] + [a for a in aliases if a != (owner or name)]))
+    if isinstance(item.get("card"), str) and item["card"].strip(): entity["card"] = item["card"].strip()[:120]
+
+ENTITY_TASK = """列出本章出现的有名有姓的人物、地点、物品、势力。新出现的要登记；已登记的如有新变化 (身份、能力、关系、状态) 就更新设定卡，没变化的不用写。
+    设定卡一句话 (50字内)：身份/能力/与主角关系/当前状态。别名包括外号、称号、简称。"""
+ENTITY_FORMAT = """[{"name": "张三", "kind": "人物", "aliases": ["三哥"], "card": "青云宗外门弟子，主角的酒肉朋友，刚突破炼气三层"}]"""
+
+def known_entities_view(folder_path, chapter_content):
+    """发给模型的已登记实体：只带本章出现过的"""
+    index = load_entities(folder_path)
+    known = {name: {k: index["entities"][name][k] for k in ("kind", "aliases", "card")}
+             for name in entity_matcher(index).find(chapter_content)}
+    return json.dumps(known, ensure_ascii=False)
+
+def update_entities(folder_path, chapter_num, chapter_content, items=None):
+    """🗂️ 增量维护实体索引：模型只看本章和本章出现过的已登记实体，首末出场由本地匹配统计。
+    items：合并后处理已经顺带登记好的实体 (已校验)，给了就不再单独请求"""
+    ok = items is not None
+    if not ok:
+        prompt = f"""
+        你是一位严谨的小说设定管理员。
+        【已登记且本章出现的实体】：{known_entities_view(folder_path, chapter_content)}
+        【最新章节】：{fused_chapter_text(chapter_content)}
+        【任务】：{ENTITY_TASK}
+        【输出格式】：只输出 JSON：{{"entities": {ENTITY_FORMAT}}}
+        """
+        try:
+            raw = engine.chat(
+                model="gemini-3-flash-preview",
+                messages=[{"role": "user", "content": prompt}],
+                timeout=60, label="实体索引", cache=USE_RESPONSE_CACHE, kind="side"
+            )
+            items = parse_json_object(raw)["entities"]
+            ok = isinstance(items, list)
+        except KeyboardInterrupt: raise
+        except: items, ok = [], False
+
+    with ENTITY_LOCK:
+        index = load_entities(folder_path)  # 分卷并行时别的卷可能刚写过
+        if index["since"] is None: index["since"] = chapter_num
+        for item in items if ok else []: merge_entity(index, item, chapter_num)
+        for name in entity_matcher(index).find(chapter_content):
+            entity = index["entities"][name]
+            entity["first"] = min(entity.get("first") or chapter_num, chapter_num)
+            entity["last"] = max(entity.get("last") or 0, chapter_num)
+        write_json(f"{folder_path}/entities.json", index)
+    record_stage(folder_path, chapter_num, "entities", hash=content_hash(chapter_content), ok=ok)
+    return ok
+
+def entity_cards(folder_path, outline, *context):
+    """🪪 本章相关实体的设定卡：细纲里点名的排前面，前情里提到的按最近出场排后面"""
+    index = load_entities(folder_path)
+    if not index["entities"]: return ""
+    matcher = entity_matcher(index)
+    named = list(matcher.find(outline))
+    mentioned = sorted((n for n in matcher.find("\n".join(c for c in context if c)) if n not in named),
+                       key=lambda n: -index["entities"][n].get("last", 0))
+    lines = []
+    for name in (named + mentioned)[:MAX_ENTITY_CARDS]:
+        entity = index["entities"][name]
+        alias = f"，又称{'/'.join(entity['aliases'])}" if entity.get("aliases") else ""
+        lines.append(f"- {name} ({entity['kind']}{alias}，第{entity['first']}章登场，最近见于第{entity['last']}章)：{entity['card'] or '暂无设定'}")
+    return "\n".join(lines)
+
+
+# ---------- 🧠 分层记忆 (章摘要 -> 段落脉络 -> 卷摘要) + 定额上下文装箱 ----------
+
+ARC_CHAPTERS = 10           # 每多少章汇总一段剧情脉络
+VOLUME_CHAPTERS = 100       # 没有分卷信息的老书按这么多章算一卷
+MEMORY_LOCK = threading.Lock()
+CJK_CHARS = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+
+def estimate_tokens(text):
+    """本地估算 token 数：中日韩字符和全角标点约 1 字 1 token，其余约 4 字符 1 token (宁多勿少)"""
+    if not text: return 0
+    cjk = len(CJK_CHARS.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def clip_to_tokens(text, budget, keep="head"):
+    """按 token 预算截断：keep="head" 保留开头，"tail" 保留结尾 (最近的内容在末尾)"""
+    if estimate_tokens(text) <= budget: return text
+    chars = text if keep == "head" else text[::-1]
+    used, cut = 0.0, 0
+    for cut, ch in enumerate(chars):
+        used += 1 if CJK_CHARS.match(ch) else 0.25
+        if used > budget - 2: break  # 留两个 token 给省略号
+    return chars[:cut] + "…" if keep == "head" else "…" + chars[:cut][::-1]
+
+def pack_context(blocks, budget):
+    """🎒 定额装箱：blocks 为 [(标题, 正文, 优先级, 单块上限, 保留头/尾)]，优先级数字小的先占预算，
+    放不下就截断，预算用完的整块丢弃；输出按原顺序排列。返回 (文本, 实际 token 数)"""
+    remaining, packed = budget, {}
+    for i in sorted(range(len(blocks)), key=lambda i: blocks[i][2]):
+        title, text, _, cap, keep = blocks[i]
+        header = f"【{title}】："
+        room = min(cap, remaining) - estimate_tokens(header) - 1  # 1 = 换行
+        if not text or room <= 0: continue
+        packed[i] = header + clip_to_tokens(text.strip(), room, keep)
+        remaining -= estimate_tokens(packed[i]) + 1
+    return "\n".join(packed[i] for i in sorted(packed)), budget - remaining
+
+class JsonlTail:
+    """增量读只追加的 JSONL：记住读到的字节位置，每次只解析新追加的整行 (末尾半行留到下次)"""
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def read_new(self):
+        try:
+            with open(self.path, "rb") as f:
+                if os.fstat(f.fileno()).st_size < self.offset: self.offset = 0  # 文件被重建过
+                f.seek(self.offset)
+                data = f.read()
+        except OSError: return []
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        records = []
+        for line in data[:end].splitlines():
+            try: records.append(json.loads(line))
+            except: pass  # 半行 (写入时崩溃) 直接忽略
+        return records
+
+class BookMemory:
+    """🧠 一本书的分层记忆：摘要库 + memory.jsonl (汇总) + 分卷划分。
+    write_chapters 开头读一次，之后每章只追读新增的行；已经齐全汇总过的段、卷记住结果，不再逐章回看"""
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.volumes = book_volumes(folder_path)
+        self.summaries = {}     # {章节号: {"hash": ..., "summary": ...}}，同一章以最后一条为准
+        self.memory = {}        # {(层级, 起始章, 结束章): {"key": 来源指纹, "summary": ...}}
+        self.settled = {}       # {(层级, 起始章, 结束章): 汇总文本}，只存齐全的
+        self._summaries = JsonlTail(os.path.join(folder_path, "summaries.jsonl"))
+        self._memory = JsonlTail(os.path.join(folder_path, "memory.jsonl"))
+        self.refresh()
+
+    def refresh(self):
+        """追读别处 (本工位的摘要流水线、分卷并行的其它卷) 新写进去的摘要和汇总"""
+        for rec in self._summaries.read_new():
+            if "chapter" in rec: self.summaries[rec["chapter"]] = rec
+        for rec in self._memory.read_new():
+            try: self.memory[(rec["level"], rec["start"], rec["end"])] = rec
+            except KeyError: pass
+
+def memory_layout(volumes, chapter_num):
+    """本书的 卷 -> 段 划分 [(卷起, 卷止, [(段起, 段止), ...])]：卷按策划时的分卷，段按卷内每 ARC_CHAPTERS 章"""
+    spans = [(start, end) for _, _, start, end in volumes]
+    if not spans or spans[-1][1] < chapter_num:
+        first = spans[-1][1] + 1 if spans else 1
+        last = max(chapter_num, first)
+        spans += [(s, min(s + VOLUME_CHAPTERS - 1, last)) for s in range(first, last + 1, VOLUME_CHAPTERS)]
+    return [(vs, ve, [(s, min(s + ARC_CHAPTERS - 1, ve)) for s in range(vs, ve + 1, ARC_CHAPTERS)]) for vs, ve in spans]
+
+def rollup(folder_path, memory, level, start, end, parts):
+    """把下一层的若干摘要汇总成一段 (来源没变就直接复用)；parts 为 [(指纹, 文本)]，失败返回 None"""
+    if not parts: return None
+    key = content_hash("|".join(fingerprint for fingerprint, _ in parts))
+    rec = memory.get((level, start, end))
+    if rec and rec.get("key") == key: return rec["summary"]
+    words, what = (300, "剧情脉络") if level == "arc" else (500, "卷摘要")
+    prompt = f"""
+    请把第 {start}-{end} 章的以下摘要浓缩成一段 {words} 字以内的{what}。
+    必须保留：关键人物及关系变化、重要道具/功法/境界、埋下的伏笔和尚未解决的悬念。
+
+    {chr(10).join(text for _, text in parts)}
+    """
+    try:
+        summary = engine.chat(
+            model="gemini-3-flash-preview",
+            messages=[{"role": "user", "content": prompt}],
+            timeout=60, label=f"{what} {start}-{end}章", cache=USE_RESPONSE_CACHE, kind="side"
+        ).strip()
+    except KeyboardInterrupt: raise
+    except: return None
+    if not summary: return None
+    rec = {"level": level, "start": start, "end": end, "key": key, "summary": summary}
+    with MEMORY_LOCK:
+        with open(os.path.join(folder_path, "memory.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    memory[(level, start, end)] = rec
+    return summary
+
+def recall_memory(book_memory, chapter_num, manifest):
+    """🧠 写第 N 章时的分层前情：([之前各卷的卷摘要], [本卷已完结各段的脉络], [本段内更早的章节摘要])。
+    只用正文哈希对得上的章节摘要；段、卷齐全了才汇总 (汇总一次后直接复用)，不齐的先用原文拼接"""
+    book_memory.refresh()
+    folder_path, summaries, memory = book_memory.folder_path, book_memory.summaries, book_memory.memory
+    settled = book_memory.settled
+    def chapter_parts(start, end):
+        parts = []
+        for n in range(start, end + 1):
+            entry = manifest.get(n)
+            summary = lookup_summary(summaries, n, entry["hash"]) if entry else None
+            if summary: parts.append((entry["hash"], f"第{n}章：{summary}"))
+        return parts
+    def arc_summary(start, end):
+        """返回 (脉络, 是否齐全)"""
+        if ("arc", start, end) in settled: return settled[("arc", start, end)], True
+        parts = chapter_parts(start, end)
+        complete = len(parts) == end - start + 1
+        summary = rollup(folder_path, memory, "arc", start, end, parts) if complete else None
+        if summary: settled[("arc", start, end)] = summary
+        return summary or "\n".join(text for _, text in parts), complete
+
+    volumes, arcs, recent = [], [], []
+    for vs, ve, arc_spans in memory_layout(book_memory.volumes, chapter_num):
+        if vs > chapter_num: break
+        if ve < chapter_num:
+            # 之前的卷：各段脉络齐全就汇总成卷摘要 (汇总成功后记住，不再逐段回看)
+            volume = settled.get(("volume", vs, ve))
+            if volume is None:
+                arc_texts, complete = [], True
+                for s, e in arc_spans:
+                    text, arc_complete = arc_summary(s, e)
+                    complete = complete and arc_complete
+                    if text: arc_texts.append((content_hash(text), f"第{s}-{e}章：{text}"))
+                volume = rollup(folder_path, memory, "volume", vs, ve, arc_texts) if complete else None
+                if volume: settled[("volume", vs, ve)] = volume
+                else: volume = " ".join(t for _, t in arc_texts)
+            if volume: volumes.append(f"第{vs}-{ve}章：{volume}")
+            continue
+        for s, e in arc_spans:
+            if e < chapter_num:
+                text, _ = arc_summary(s, e)
+                if text: arcs.append(f"第{s}-{e}章：{text}")
+            elif s < chapter_num - 1:
+                # 本段：上一章以前的章节摘要原样给 (上一章走前情提要)
+                recent = [text for _, text in chapter_parts(s, chapter_num - 2)]
+    return volumes, arcs, recent
+
+def build_chapter_context(folder_path, chapter_num, manifest, book_memory, bible, outline, prev_summary, prev_tail, assets_data):
+    """🎒 按固定预算装配第 N 章的上下文：越近越重要，远处的前情只留汇总。返回 (档案文本, 上下文文本)"""
+    volumes, arcs, recent = recall_memory(book_memory, chapter_num, manifest)
+    cards = entity_cards(folder_path, outline, prev_summary, prev_tail)
+    budget = CONTEXT_TOKEN_BUDGET
+    print(f"    └── 🧠 分层记忆：前卷 {len(volumes)} 卷 · 本卷 {len(arcs)} 段 · 近章 {len(recent)} 章 · 设定卡 {cards.count(chr(10)) + 1 if cards else 0} 张")
+    assets_text = clip_to_tokens(assets_data or "", budget // 5, "head")
+    assets_tokens = estimate_tokens(assets_text)
+    context, context_tokens = pack_context([
+        ("世界观", bible, 4, budget // 4, "head"),
+        ("前卷回顾", "\n".join(volumes), 5, budget // 5, "tail"),
+        ("本卷脉络", "\n".join(arcs), 3, budget // 4, "tail"),
+        ("近章摘要", "\n".join(recent), 2, budget // 5, "tail"),
+        ("本章相关设定卡", cards, 2, budget // 5, "head"),
+        ("前情提要", prev_summary, 1, budget // 10, "head"),
+        ("上章结尾", prev_tail, 1, budget // 10, "tail"),
+    ], budget - assets_tokens)
+    print(f"    └── 🎒 上下文约 {assets_tokens + context_tokens}/{budget} tokens")
+    return assets_text, context
+
 
 # ==========================================
 #              5. AI 核心生成系统
@@ -281,12 +1163,11 @@ def design_twist(chapter_num, outline, prev_summary):
     不要写正文，只给思路，100字以内。
     """
     try:
-        response = client.chat.completions.create(
+        return engine.chat(
             model="gemini-3-flash-preview",
             messages=[{"role": "user", "content": prompt}],
-            timeout=30
+            timeout=30, label=f"第{chapter_num}章反转构思", cache=USE_RESPONSE_CACHE, kind="side"
         )
-        return response.choices[0].message.content
     except:
         return "本章重点制造冲突，结尾留悬念。"
 
@@ -300,23 +1181,77 @@ def generate_seo_title(chapter_content, outline_title):
     【要求】：使用“震惊”、“竟然”、“神级”等词，展示核心爽点，10-20字，只输出标题内容。
     """
     try:
-        response = client.chat.completions.create(
+        title = engine.chat(
             model="gemini-3-flash-preview",
             messages=[{"role": "user", "content": prompt}],
-            timeout=30
+            timeout=30, label="SEO拟题", cache=USE_RESPONSE_CACHE, kind="side"
         )
-        return response.choices[0].message.content.strip().replace('"', '').replace('标题：', '')
+        return title.strip().replace('"', '').replace('标题：', '')
     except:
         return outline_title
 
-def generate_chapter_robust(chapter_num, outline, prev_summary, prev_text_tail, bible, is_final_chapter, assets_data):
-    global client
+def load_partial(partial_path):
+    return (read_file(partial_path) or "") if partial_path else ""
+
+def save_partial(partial_path, text):
+    """断点稿落盘 (先写临时文件再替换，崩溃时不会留下半截断点)"""
+    if not partial_path or not text: return
+    atomic_write(partial_path, text)
+
+def resume_prompt(user_prompt, draft, closing=False):
+    """已有断点稿时，让模型从断点处接着写 (closing=True：字数已够，只需接上半句收尾)"""
+    if not draft: return user_prompt
+    task = ("本章字数已经够了，请先把断在半句的地方接上，再用几百字收束本章 (留好钩子)"
+            if closing else "请紧接上文继续写完本章")
+    return user_prompt + f"""
+    【本章已写部分 (结尾)】：...{draft[-800:]}
+    👉 {task}，不要重复已写内容，不要重新开头：
+    """
+
+def ends_cleanly(text):
+    """稿子是不是停在句末 (而不是断在半句)"""
+    text = text.rstrip()
+    return bool(text) and text[-1] in SENTENCE_ENDINGS
+
+def finish_draft(chapter_num, system_prompt, user_prompt, draft, partial_path, subtitle, is_climax=False):
+    """🪡 字数已达标但断在半句的稿子：按健康度挑模型续写一轮收尾 (高潮章只用贵族模型)，都失败就按原稿采用"""
+    pool = TIER_1_NOBLES if is_climax else TIER_1_NOBLES + TIER_2_KNIGHTS + TIER_3_PEASANTS
+    for model_name in engine.router.rank(pool):
+        try:
+            log(f"🪡 第 {chapter_num} 章停在半句 ({len(draft)} 字)，由 {model_name} 续写收尾...")
+            text = call_writer_model(
+                model_name, system_prompt, resume_prompt(user_prompt, draft, closing=True),
+                f"{subtitle} | 🪡 {model_name}", draft, partial_path, temperature=0.9
+            )
+            if text: return draft + text
+        except KeyboardInterrupt: raise
+        except StreamInterrupted as e:
+            draft += e.partial
+            save_partial(partial_path, draft)
+            if ends_cleanly(draft): return draft
+        except Exception as e: log(f"❌ 收尾续写失败 ({model_name}): {str(e)[:50]}")
+    log(f"⚠️ 第 {chapter_num} 章收尾续写全部失败，按现有稿子采用 ({len(draft)} 字)。")
+    return draft
+
+def call_writer_model(model_name, system_prompt, prompt, label, draft="", partial_path=None, kind="chapter", **params):
+    """单次正文调用 (kind：自适应超时按哪类调用统计)；流式模式下每隔几秒把 (断点稿 + 新内容) 写进 .partial，超时由看门狗管"""
+    messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}]
+    if not STREAM_MODE:
+        return engine.chat(model=model_name, messages=messages, timeout=TIMEOUT_SECONDS, label=label, kind=kind, **params)
+    return engine.stream_chat(
+        model=model_name, messages=messages, stall_timeout=STALL_TIMEOUT_SECONDS,
+        on_progress=lambda text: save_partial(partial_path, draft + text),
+        timeout=TIMEOUT_SECONDS, label=label, **params
+    )
+
+def generate_chapter_robust(chapter_num, outline, prev_summary, prev_text_tail, bible, is_final_chapter, assets_data, twist_instruction=None, partial_path=None, context=None):
     clean_outline = outline.replace("\n", " ").strip()
     subtitle = clean_outline[:20] + "..." if len(clean_outline) > 20 else clean_outline
 
-    # 1. 构思反转
-    print(f"    └── 🎭 正在构思本章反转点...", end="\r")
-    twist_instruction = design_twist(chapter_num, clean_outline, prev_summary)
+    # 1. 构思反转 (流水线可能已提前备好)
+    if twist_instruction is None:
+        print(f"    └── 🎭 正在构思本章反转点...", end="\r")
+        twist_instruction = design_twist(chapter_num, clean_outline, prev_summary)
 
     # 2. 判定高潮 & 模型池
     is_climax = False
@@ -324,10 +1259,6 @@ def generate_chapter_robust(chapter_num, outline, prev_summary, prev_text_tail,
         if kw in clean_outline: is_climax = True; break
     if is_final_chapter: is_climax = True
 
-    attempt_queue = []
-    attempt_queue.extend(TIER_1_NOBLES) 
-    if not is_climax: attempt_queue.extend(TIER_2_KNIGHTS)
-    
     print(f"\n🚀 [本章策略] 优先 Pro/High -> Low (禁用Flash)")
     if is_climax: print(f"🔥 [高潮模式] 封锁 Low 模型权限，死磕 Pro！")
 
@@ -346,131 +1277,893 @@ def generate_chapter_robust(chapter_num, outline, prev_summary, prev_text_tail,
     if is_climax:
         system_prompt += "\n🌟【高潮模式】：本章为关键剧情，战斗要剧烈，情感要爆发，文笔要华丽！"
 
+    if context is None:  # 没有装箱好的上下文就按老办法截取
+        context = f"【世界观】：{bible[:1000]}...\n【前情提要】：{prev_summary}\n【上章结尾】：...{prev_text_tail}"
     user_prompt = f"""
-    【世界观】：{bible[:1000]}...
-    【前情提要】：{prev_summary}
-    【上章结尾】：...{prev_text_tail}
+    {context}
     【本章任务】：第 {chapter_num} 章：{outline}
     👉 请开始正文创作（直接写正文）：
     """
+
+    # 🧯 上次崩溃/中断留下的断点稿：够长直接抢救，不够长就从断点续写
+    draft = load_partial(partial_path)
+    if draft:
+        if len(draft) >= MIN_CHAPTER_CHARS:
+            if ends_cleanly(draft):
+                log(f"🧯 发现第 {chapter_num} 章断点稿 ({len(draft)} 字)，字数已达标，直接抢救。")
+                return draft
+            return finish_draft(chapter_num, system_prompt, user_prompt, draft, partial_path, subtitle, is_climax)
+        log(f"🧯 发现第 {chapter_num} 章断点稿 ({len(draft)} 字)，将从断点处续写。")
+    continuation_rounds = 0
+    failed_rounds = 0
     
     while True:
-        # 阶段一：尝试贵族模型
-        for model_name in attempt_queue:
-            stop_heartbeat = threading.Event()
-            t = threading.Thread(target=heartbeat, args=(stop_heartbeat, f"{subtitle} | 👑 {model_name}"))
-            t.daemon = True
+        # 阶段一：尝试贵族模型 (梯队顺序不变，梯队内按健康度排序，熔断中的模型跳过)
+        attempt_queue = engine.router.rank(TIER_1_NOBLES)
+        if not is_climax: attempt_queue += engine.router.rank(TIER_2_KNIGHTS)
+
+        # 🏇 高潮章对冲：同一提示词交给两个 Pro 模型赛跑，先交可用稿者胜，另一路立即取消
+        # (对冲走非流式请求：没有 .partial 断点稿和卡死看门狗，所以 --stream 下不开对冲)
+        if is_climax and HEDGE_DELAY_SECONDS is not None and len(attempt_queue) >= 2:
+            try:
+                plan = f"{HEDGE_DELAY_SECONDS}s 未交稿则追加" if HEDGE_DELAY_SECONDS else "同时派出"
+                log(f"🏇 第 {chapter_num} 章 | 对冲模式: {attempt_queue[0]} 先行，{plan} {attempt_queue[1]}...")
+                model_name, text = engine.hedged_chat(
+                    attempt_queue,
+                    [{"role": "system", "content": system_prompt}, {"role": "user", "content": resume_prompt(user_prompt, draft)}],
+                    hedge_delay=HEDGE_DELAY_SECONDS,
+                    accept=lambda c: bool(c) and (len(draft + c) >= MIN_CHAPTER_CHARS or len(c) >= MIN_DRAFT_CHARS),
+                    temperature=0.95, presence_penalty=0.6, timeout=TIMEOUT_SECONDS, label=subtitle, kind="chapter"
+                )
+                content = draft + text
+                sys.stdout.write("\r" + " " * 80 + "\r")
+                if len(content) >= MIN_CHAPTER_CHARS:
+                    log(f"✅ 生成完毕 (字数: {len(content)}) - By {model_name} (对冲胜出)")
+                    return content
+                # ✂️ 胜出稿短但可用：保留草稿，由胜出模型走常规续写
+                continuation_rounds += 1
+                draft = content
+                save_partial(partial_path, draft)
+                log(f"✂️ 对冲胜出稿字数不足 ({len(content)}/{MIN_CHAPTER_CHARS})，保留草稿，由 {model_name} 续写...")
+                attempt_queue = [model_name] + [m for m in attempt_queue if m != model_name]
+            except KeyboardInterrupt: raise
+            except Exception as e:
+                sys.stdout.write("\r" + " " * 80 + "\r")
+                log(f"❌ 对冲请求全部失败: {str(e)[:50]}...")
+                attempt_queue = []
+
+        while attempt_queue:
+            model_name = attempt_queue[0]
             try:
-                log(f"🎬 第 {chapter_num} 章 | 正在调用贵族模型: {model_name}...")
-                t.start()
-                response = client.chat.completions.create(
-                    model=model_name,
-                    messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
-                    temperature=0.95, presence_penalty=0.6, timeout=TIMEOUT_SECONDS 
+                timeout = TIMEOUT_SECONDS if STREAM_MODE else engine.router.timeout_for(model_name, TIMEOUT_SECONDS, "chapter")
+                resume_note = f" [续写: 已有 {len(draft)} 字]" if draft else ""
+                log(f"🎬 第 {chapter_num} 章 | 正在调用贵族模型: {model_name} (超时 {timeout}s){resume_note}...")
+                text = call_writer_model(
+                    model_name, system_prompt, resume_prompt(user_prompt, draft), f"{subtitle} | 👑 {model_name}",
+                    draft, partial_path, temperature=0.95, presence_penalty=0.6
                 )
-                stop_heartbeat.set(); t.join() 
                 sys.stdout.write("\r" + " " * 80 + "\r")
+                content = draft + (text or "")
                 
-                content = response.choices[0].message.content
-                if content and len(content) >= 1500:
+                if len(content) >= MIN_CHAPTER_CHARS:
                     log(f"✅ 生成完毕 (字数: {len(content)}) - By {model_name}")
                     return content
+                if len(text or "") >= MIN_DRAFT_CHARS and continuation_rounds < MAX_CONTINUATION_ROUNDS:
+                    # ✂️ 短但可用：保留草稿，同一模型从结尾接着写
+                    continuation_rounds += 1
+                    draft = content
+                    save_partial(partial_path, draft)
+                    log(f"✂️ 字数不足 ({len(content)}/{MIN_CHAPTER_CHARS})，保留草稿，第 {continuation_rounds}/{MAX_CONTINUATION_ROUNDS} 轮续写...")
+                    continue
+                engine.router.record_failure(model_name)
+                if continuation_rounds >= MAX_CONTINUATION_ROUNDS and draft:
+                    log(f"⚠️ 续写 {MAX_CONTINUATION_ROUNDS} 轮仍不达标，丢弃草稿，切换下一个贵族模型重写...")
+                    draft = ""; continuation_rounds = 0
+                    if partial_path and os.path.exists(partial_path): os.remove(partial_path)
                 else:
                     log(f"⚠️ 字数不足，切换下一个贵族模型...")
-                    continue 
-            except KeyboardInterrupt: stop_heartbeat.set(); raise KeyboardInterrupt 
+                attempt_queue.pop(0)
+            except KeyboardInterrupt: raise 
+            except StreamInterrupted as e:
+                sys.stdout.write("\r" + " " * 80 + "\r")
+                draft += e.partial
+                save_partial(partial_path, draft)
+                log(f"🧊 {model_name} 流式中断: {str(e)[:50]} | 断点稿累计 {len(draft)} 字")
+                if len(draft) >= MIN_CHAPTER_CHARS:
+                    if ends_cleanly(draft):
+                        log(f"✅ 断点稿字数已达标，直接采用 (字数: {len(draft)})")
+                        return draft
+                    return finish_draft(chapter_num, system_prompt, user_prompt, draft, partial_path, subtitle, is_climax)
+                attempt_queue.pop(0)
             except Exception as e:
-                stop_heartbeat.set(); t.join()
                 sys.stdout.write("\r" + " " * 80 + "\r")
                 log(f"❌ 贵族模型 {model_name} 报错: {str(e)[:50]}...")
-                continue 
+                attempt_queue.pop(0)
         
         # 阶段二：熔断处理
         log("⚠️ 警报：所有 Pro/High/Low 模型均无法响应！")
+        failed_rounds += 1
         if is_climax:
-            log("🛑 高潮章节拒绝降级！等待 30 秒冷却后重试 Pro...")
-            time.sleep(30); continue 
+            wait = backoff_delay(failed_rounds, base=30, cap=300)
+            log(f"🛑 高潮章节拒绝降级！等待 {wait:.0f} 秒冷却后重试 Pro (第 {failed_rounds} 轮)...")
+            time.sleep(wait); continue 
         
         log("🚑 启用【平民模型 (Flash)】进行熔断救急...")
-        for model_name in TIER_3_PEASANTS:
+        for model_name in engine.router.rank(TIER_3_PEASANTS):
             try:
-                response = client.chat.completions.create(
-                    model=model_name,
-                    messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
-                    temperature=0.8, timeout=TIMEOUT_SECONDS
+                text = call_writer_model(
+                    model_name, system_prompt, resume_prompt(user_prompt, draft), f"{subtitle} | 🚑 {model_name}",
+                    draft, partial_path, kind="rescue", temperature=0.8
                 )
-                content = response.choices[0].message.content
+                content = draft + (text or "")
                 log(f"✅ Flash 救急完成 (字数: {len(content)})。")
                 return content
+            except KeyboardInterrupt: raise
+            except StreamInterrupted as e:
+                draft += e.partial
+                save_partial(partial_path, draft)
+                log(f"❌ Flash 也断流了: {str(e)[:50]} | 断点稿累计 {len(draft)} 字")
             except Exception as e: log(f"❌ Flash 也挂了: {e}")
         
-        log("😴 全网瘫痪，冷却 20 秒...")
-        time.sleep(20)
+        wait = backoff_delay(failed_rounds, base=20, cap=300)
+        log(f"😴 全网瘫痪，冷却 {wait:.0f} 秒 (第 {failed_rounds} 轮)...")
+        time.sleep(wait)
 
 def summarize_chapter(content):
     try:
         prompt = f"请用200字总结以下章节的关键剧情：\n\n{content[:2000]}"
-        response = client.chat.completions.create(
+        return engine.chat(
             model="gemini-3-flash-preview", 
             messages=[{"role": "user", "content": prompt}],
-            timeout=60
+            timeout=60, label="章节摘要", cache=USE_RESPONSE_CACHE, kind="side"
         )
-        return response.choices[0].message.content
-    except: return "（摘要生成失败）"
+    except: return SUMMARY_FAILED
+
+def summarize_and_store(folder_path, chapter_num, content):
+    """生成摘要并写入摘要库"""
+    summary = summarize_chapter(content)
+    save_summary(folder_path, chapter_num, content, summary)
+    return summary
+
+# ---------- 🧬 合并后处理：标题 + 摘要 + 档案 一次请求 ----------
+
+FUSED_SAMPLE_CHARS = 6000   # 正文不超过这个长度就整章发送，否则发 开头2000 + 结尾4000
+
+def fused_chapter_text(content):
+    if len(content) <= FUSED_SAMPLE_CHARS: return content
+    return f"{content[:2000]}\n……(中略)……\n{content[-4000:]}"
+
+def parse_fused_result(raw):
+    """解析并校验合并后处理的 JSON：标题/摘要/档案任何一项不合格都返回 None；
+    只有实体列表不合格时 entities 为 None (由调用方单独补一次实体索引)"""
+    try:
+        data = parse_json_object(raw)
+        title, summary = data["title"], data["summary"]
+        delta = validate_assets_delta(data["assets"])
+    except: return None
+    if delta is None or not all(isinstance(v, str) and v.strip() for v in (title, summary)): return None
+    title = title.strip().replace('"', '').replace('标题：', '')
+    if len(title) > 40 or len(summary) < 20: return None
+    entities = data.get("entities")
+    return {"title": title, "summary": summary.strip(), "assets": delta,
+            "entities": entities if isinstance(entities, list) else None}
+
+def postprocess_chapter_fused(folder_path, chapter_num, content, outline_title):
+    """🧬 一次 Flash 请求同时拿到 SEO 标题、章节摘要、档案变更、实体登记；校验不过就退回独立调用。
+    返回 {"title", "summary", "entities"}，档案和摘要库在这里落盘，实体交给 update_entities (entities 为 None 时它会单独请求)。"""
+    ledger = ledger_before(folder_path, chapter_num)
+    prompt = f"""
+    你同时担任标题党大师、剧情编辑和严谨的小说档案管理员。
+    【原细纲标题】：{outline_title}
+    【当前档案】：{assets_prompt_view(ledger)}
+    【已登记且本章出现的实体】：{known_entities_view(folder_path, content)}
+    【最新章节正文】：{fused_chapter_text(content)}
+
+    【任务】：
+    1. title：取一个最吸引眼球、符合SEO优化的章节标题，使用“震惊”、“竟然”、“神级”等词，展示核心爽点，10-20字。
+    2. summary：用200字总结本章关键剧情。
+    3. assets：本章带来的面板、资产、人际、状态变化和时间线大事，只写变更，值为 null 表示删除，例如 {ASSETS_DELTA_FORMAT}
+    4. entities：{ENTITY_TASK}
+    例如 {ENTITY_FORMAT}
+
+    【输出格式】：只输出一个 JSON 对象：{{"title": "...", "summary": "...", "assets": {{...}}, "entities": [...]}}
+    """
+    result = None
+    try:
+        raw = engine.chat(
+            model="gemini-3-flash-preview",
+            messages=[{"role": "user", "content": prompt}],
+            timeout=90, label=f"第{chapter_num}章合并后处理", cache=USE_RESPONSE_CACHE, kind="side"
+        )
+        result = parse_fused_result(raw or "")
+    except KeyboardInterrupt: raise
+    except: pass
+
+    if result is None:
+        log(f"⚠️ 第 {chapter_num} 章合并后处理结果不合格，改为分开调用 标题/审计/摘要...")
+        title = generate_seo_title(content, outline_title)
+        update_assets(folder_path, chapter_num, content)
+        return {"title": title, "summary": summarize_and_store(folder_path, chapter_num, content), "entities": None}
+
+    commit_assets(folder_path, ledger, result["assets"], chapter_num)
+    record_stage(folder_path, chapter_num, "assets", hash=content_hash(content), ok=True)
+    save_summary(folder_path, chapter_num, content, result["summary"])
+    if result["entities"] is None: log(f"⚠️ 第 {chapter_num} 章合并后处理的实体列表不合格，实体索引改为单独请求...")
+    return {"title": result["title"], "summary": result["summary"], "entities": result["entities"]}
+
 
 def generate_marketing_intro(folder_path, bible, outline_raw):
-    global client
     print("\n" + "="*50)
     log("🔥 正在生成【发文专用·SEO简介】...")
     prompt = f"请阅读这本小说，写一段300字左右的爆款发文简介。素材：{bible[:2000]}"
+    failed_rounds = 0
     while True:
-        for model_name in ULTIMATE_POOL:
+        for model_name in engine.router.rank(ULTIMATE_POOL):
             try:
                 log(f"🎬 正在调用: {model_name} 生成简介...")
-                response = client.chat.completions.create(
-                    model=model_name, messages=[{"role": "user", "content": prompt}], timeout=120
+                intro_content = engine.chat(
+                    model=model_name, messages=[{"role": "user", "content": prompt}], timeout=120,
+                    label=f"发文简介 | {model_name}", kind="intro"
                 )
-                intro_content = response.choices[0].message.content
                 with open(f"{folder_path}/发文简介_SEO版.txt", "w", encoding="utf-8") as f: f.write(intro_content)
                 log(f"✅ 爆款简介已生成。")
                 print("="*50 + "\n"); return 
             except Exception as e:
-                log(f"❌ {model_name} 失败: {str(e)[:50]}..."); time.sleep(2)
-        log("😴 帝王池模型繁忙，冷却 20 秒后重试..."); time.sleep(20)
+                log(f"❌ {model_name} 失败: {str(e)[:50]}...")
+        failed_rounds += 1
+        wait = backoff_delay(failed_rounds, base=20, cap=300)
+        log(f"😴 帝王池模型繁忙，冷却 {wait:.0f} 秒后重试..."); time.sleep(wait)
+
+# ---------- 🧵 分卷并行 (交接状态 + 接缝修整) ----------
+
+HANDOFF_FORMAT = """{"summary": "新卷开始时主角处境、主线进展与悬念 (300字内)", "assets": """ + ASSETS_DELTA_FORMAT + "}"
+SEAM_OPENING_CHARS = 1200   # 接缝修整只重写新卷第一章开头这么多字 (按段落取整)
+
+def ask_nobles(prompt, label, kind, timeout=300):
+    """按健康度依次试第一梯队模型，全部失败返回 None (不死磕，调用方有退路)"""
+    for model_name in engine.router.rank(TIER_1_NOBLES):
+        try:
+            return engine.chat(model=model_name, messages=[{"role": "user", "content": prompt}],
+                               timeout=timeout, label=f"{label} | {model_name}", kind=kind)
+        except KeyboardInterrupt: raise
+        except Exception as e:
+            log(f"❌ {label} {model_name} 失败: {str(e)[:50]}...")
+    return None
+
+def synthesize_handoff(folder_path, chapter_num, volume_name, bible, outlines):
+    """🧵 推演第 chapter_num 章 (新卷开头) 开写时的状态：前情 + 档案，存入 handoffs/N.json，失败返回 None"""
+    handoff = load_handoff(folder_path, chapter_num)
+    if handoff: return handoff
+    log(f"🧵 第 {chapter_num} 章是【{volume_name}】开篇，前一卷还没写到，正在推演交接状态...")
+    before = "\n".join(outlines[max(0, chapter_num - 31):chapter_num - 1])
+    after = "\n".join(outlines[chapter_num - 1:chapter_num + 9])
+    base = load_ledger_at(folder_path, 0) or initial_ledger()
+    prompt = f"""
+    你是一位长篇网文的主编。本书按卷并行创作，现在要直接从【{volume_name}】开写，请推演开卷时的故事状态。
+    【世界观与分卷大纲】：{bible[:6000]}
+    【上一卷结尾的细纲】：
+    {before or "无"}
+    【本卷开头的细纲】：
+    {after}
+    【开书时的档案】：{assets_prompt_view(base)}
+    【任务】：
+    1. summary：写清楚开卷时主角的处境、已发生的主线大事和悬念，供执笔人当作“前情提要”。
+    2. assets：相对开书档案，到本卷开头为止面板、资产、人际、状态的变化，以及前几卷的关键时间线大事。
+    【输出格式】：只输出一个 JSON 对象：{HANDOFF_FORMAT}
+    """
+    try:
+        data = parse_json_object(ask_nobles(prompt, f"第{chapter_num}章交接状态", "handoff") or "")
+        summary, delta = str(data["summary"]).strip(), validate_assets_delta(data["assets"])
+    except Exception: return None
+    if delta is None or len(summary) < 20: return None
+    handoff = {"chapter": chapter_num, "volume": volume_name, "summary": summary,
+               "ledger": apply_assets_delta(base, delta, chapter_num - 1)}
+    os.makedirs(os.path.join(folder_path, "handoffs"), exist_ok=True)
+    write_json(handoff_path(folder_path, chapter_num), handoff)
+    return handoff
+
+def seam_opening(body):
+    """按段落切出开头约 SEAM_OPENING_CHARS 字"""
+    paragraphs = body.split("\n")
+    size = 0
+    for i, p in enumerate(paragraphs):
+        size += len(p) + 1
+        if size >= SEAM_OPENING_CHARS: return "\n".join(paragraphs[:i + 1]), "\n".join(paragraphs[i + 1:])
+    return body, ""
+
+def reconcile_volume_seams(folder_path):
+    """🪡 接缝修整：按交接状态开写的新卷首章，等前一卷真正写完后，
+    对照真实结尾重写开头做衔接，再沿着这一卷按真实档案重新审计 (档案链接回真实状态)"""
+    journal = load_journal(folder_path) or {}
+    seams = sorted(n for n, stages in journal.items() if stages.get("text", {}).get("handoff"))
+    if not seams: return
+    manifest = BookManifest(folder_path)
+    written = lambda n: (manifest.get(n) or {}).get("size", 0) > 100
+    for seam in seams:
+        if not (written(seam) and written(seam - 1)): continue
+        log(f"🪡 正在修整第 {seam - 1}/{seam} 章的分卷接缝...")
+        text = read_file(manifest.chapter_path(seam))
+        header, body = (text.split("\n\n", 1) + [""])[:2] if text.startswith("第 ") else ("", text)
+        opening, rest = seam_opening(body)
+        prev_tail = chapter_body(read_file(manifest.chapter_path(seam - 1)))[-800:]
+        handoff = load_handoff(folder_path, seam) or {}
+        prompt = f"""
+        你是一位网文精修编辑。下一章是按推演的前情提前写好的，现在上一章真正写完了，请修整两章之间的接缝。
+        【上一章结尾 (真实)】：{prev_tail}
+        【真实档案】：{render_assets(ledger_before(folder_path, seam))}
+        【当初推演的前情】：{handoff.get("summary", "无")}
+        【下一章开头 (待修整)】：{opening}
+        【任务】：重写“下一章开头”，让它紧接上一章结尾，人物状态、道具、位置与真实档案一致；
+        保持原有情节走向、字数相当，结尾要能自然接上后文。只输出重写后的开头正文。
+        """
+        bridged = (ask_nobles(prompt, f"第{seam}章接缝修整", "seam") or "").strip()
+        if len(bridged) >= len(opening) // 2:
+            body = bridged + ("\n" + rest if rest else "")
+            final_content = f"{header}\n\n{body}" if header else body
+            atomic_write(manifest.chapter_path(seam), final_content)
+            manifest.record(seam, final_content)
+            summarize_and_store(folder_path, seam, body)
+            update_entities(folder_path, seam, body)
+        else:
+            log(f"⚠️ 第 {seam} 章接缝修整失败，保留原文，只重新审计档案。")
+        record_stage(folder_path, seam, "text", hash=content_hash(body), seam=True)
+        # 本卷后续章节的档案都建立在推演状态上，沿链按真实状态重审 (直到下一个接缝或未写章节)
+        n = seam
+        while written(n) and (n == seam or n not in seams):
+            update_assets(folder_path, n, chapter_body(read_file(manifest.chapter_path(n))))
+            n += 1
+
+# ==========================================
+#              6. 任务队列 & 无人值守守护模式
+# ==========================================
+
+# 队列库放本机 (SQLite 不能跨主机在网络盘上共用)，按书库目录区分，同一台机器上的守护进程共用
+JOB_DB = local_state_path(f"jobs_{hashlib.sha1(os.path.abspath('.').encode('utf-8')).hexdigest()[:10]}.db")
+DAEMON_POLL_SECONDS = 30
+MAX_JOB_ATTEMPTS = 3
+JOB_RETRY_SECONDS = 600     # 任务失败后多久再重试
+
+class JobQueue:
+    """📮 持久化任务队列 (SQLite)：一条任务 = 一本书的一段章节范围
+
+    按 优先级 (大的先) -> 截止时间 (早的先，没有截止的排后) -> 入队顺序 出队；
+    队列是单机的：同一台机器上的多个守护进程共用。多台主机共享书库时各跑各的队列 (都会自动发现新书)，
+    防止两边同写一本书的是书籍租约锁。
+    """
+    def __init__(self, db_path=JOB_DB):
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, book TEXT NOT NULL,
+                start_ch INTEGER DEFAULT 1, end_ch INTEGER, priority INTEGER DEFAULT 0, deadline REAL,
+                status TEXT DEFAULT 'queued', owner TEXT, attempts INTEGER DEFAULT 0,
+                not_before REAL DEFAULT 0, error TEXT, created REAL, updated REAL)""")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def enqueue(self, book, start=1, end=None, priority=0, deadline=None):
+        now = time.time()
+        conn = self._connect()
+        try:
+            cur = conn.execute("""INSERT INTO jobs (book, start_ch, end_ch, priority, deadline, created, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""", (book, start, end, priority, deadline, now, now))
+            return cur.lastrowid
+        finally:
+            conn.close()
+
+    def known_books(self):
+        conn = self._connect()
+        try: return {row["book"] for row in conn.execute("SELECT DISTINCT book FROM jobs")}
+        finally: conn.close()
+
+    def jobs(self, statuses=None):
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT * FROM jobs ORDER BY status != 'running', status != 'queued', "
+                                "priority DESC, deadline IS NULL, deadline, id").fetchall()
+            return [dict(r) for r in rows if not statuses or r["status"] in statuses]
+        finally:
+            conn.close()
+
+    def claim(self, owner, try_take, untake=None):
+        """按队列顺序找第一条 try_take(任务) 返回 True 的任务 (try_take 负责抢书籍锁)，标记为运行中。
+        抢锁、读清单这些慢活不在事务里做；事务里只有一条“还在排队才改成运行中”的更新，
+        没抢到 (别的工位先改了) 就用 untake(任务) 放掉刚抢的锁。"""
+        conn = self._connect()
+        try:
+            rows = conn.execute("""SELECT * FROM jobs WHERE status='queued' AND not_before<=?
+                ORDER BY priority DESC, deadline IS NULL, deadline, id""", (time.time(),)).fetchall()
+            for row in rows:
+                job = dict(row)
+                if not try_take(job): continue
+                cur = conn.execute("UPDATE jobs SET status='running', owner=?, updated=? WHERE id=? AND status='queued'",
+                                   (owner, time.time(), job["id"]))
+                if cur.rowcount == 1: return job
+                if untake: untake(job)
+            return None
+        finally:
+            conn.close()
+
+    def finish(self, job_id, status, error=None):
+        """status: done / queued (被打断，原样放回) / failed (计一次失败，到上限后不再重试)"""
+        conn = self._connect()
+        try:
+            now = time.time()
+            if status == "failed":
+                row = conn.execute("SELECT attempts FROM jobs WHERE id=?", (job_id,)).fetchone()
+                attempts = (row["attempts"] if row else 0) + 1
+                final = "failed" if attempts >= MAX_JOB_ATTEMPTS else "queued"
+                conn.execute("UPDATE jobs SET status=?, attempts=?, not_before=?, error=?, owner=NULL, updated=? WHERE id=?",
+                             (final, attempts, now + JOB_RETRY_SECONDS, error, now, job_id))
+            else:
+                conn.execute("UPDATE jobs SET status=?, owner=NULL, updated=? WHERE id=?", (status, now, job_id))
+        finally:
+            conn.close()
+
+    def requeue_orphans(self):
+        """运行中的任务，其书籍锁已不在 (持有者崩溃/租约过期) -> 放回队列"""
+        for job in self.jobs({"running"}):
+            if os.path.isdir(job["book"]) and is_locked(job["book"]): continue
+            self.finish(job["id"], "queued")
+            log(f"♻️ 任务 #{job['id']} ({job['book']}) 的执行者已失联，重新排队。")
+
+def parse_deadline(text):
+    if not text: return None
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try: return datetime.datetime.strptime(text, fmt).timestamp()
+        except ValueError: pass
+    raise argparse.ArgumentTypeError(f"截止时间格式应为 YYYY-MM-DD 或 'YYYY-MM-DD HH:MM'：{text}")
+
+def parse_chapter_range(text):
+    """'10-50' / '10-' / '50' (=1-50)"""
+    if not text: return 1, None
+    match = re.fullmatch(r'\s*(\d*)\s*-\s*(\d*)\s*', text)
+    if match: return int(match.group(1) or 1), (int(match.group(2)) if match.group(2) else None)
+    if text.strip().isdigit(): return 1, int(text)
+    raise argparse.ArgumentTypeError(f"章节范围格式应为 起-止，例如 10-50：{text}")
+
+def chapters_before_ready(book, start):
+    """章节范围之前的章节必须都已写完 (没有前文就没法续写)；分卷并行模式下从某一卷开头起写不受限 (用交接状态开篇)"""
+    if start <= 1: return True
+    if VOLUME_PARALLEL and start in {v[2] for v in book_volumes(book)}: return True
+    manifest = BookManifest(book)
+    return all((manifest.get(n) or {}).get("size", 0) > 100 for n in range(1, start))
+
+def take_job(job):
+    book = job["book"]
+    if not os.path.isdir(book) or is_locked(book): return False
+    if not chapters_before_ready(book, job["start_ch"]): return False
+    if not outline_ready(book, job["start_ch"]): return False  # 策划机还没写出这段细纲
+    # 细纲停滞的书：写到头也只会再次暂停，等策划机有进展 (updated 刷新) 再领，免得工位空转反复领取
+    if outline_stalled(load_outline(book)[1]): return False
+    return lock_book(book)
+
+def settle_vanished_jobs(queue):
+    """书籍目录已经不在了：完结改名的算完成，其余标记失败"""
+    for job in queue.jobs({"queued"}):
+        if os.path.isdir(job["book"]): continue
+        finished = os.path.isdir(f"【已完结】_{job['book']}")
+        queue.finish(job["id"], "done" if finished else "failed", None if finished else "书籍目录不存在")
+
+def discover_books(queue):
+    """🔭 新出现的 Book_* 目录自动入队 (整本书，默认优先级)"""
+    known = queue.known_books()
+    for book in sorted(d for d in os.listdir('.') if os.path.isdir(d) and d.startswith("Book_")):
+        if book in known: continue
+        job_id = queue.enqueue(book)
+        log(f"🔭 发现新书 {book}，已加入任务队列 (#{job_id})。")
+
+def daemon_worker(worker_id, queue, claimed):
+    """🌙 守护工位：从任务队列取活，没活就等，直到收到停止信号"""
+    owner = f"{HOST_NAME}:{os.getpid()}:{worker_id}"
+    while not STOP_EVENT.is_set():
+        job = queue.claim(owner, take_job, lambda job: unlock_book(job["book"]))
+        if not job:
+            STOP_EVENT.wait(DAEMON_POLL_SECONDS); continue
+        folder_path = job["book"]
+        claimed.add(folder_path)
+        book_name = folder_path.replace("Book_", "").split("_")[-1]
+        span = f"第{job['start_ch']}-{job['end_ch'] or '末'}章"
+        late = " ⚠️ 已过截止时间" if job["deadline"] and job["deadline"] < time.time() else ""
+        log(f"🌙 工位{worker_id} 领取任务 #{job['id']}：{folder_path} {span} (优先级 {job['priority']}){late}")
+        enter_lane(f"工位{worker_id}·{book_name}", os.path.join(folder_path, "writer.log"))
+        try:
+            done = write_book(folder_path, first_chapter=job["start_ch"], last_chapter=job["end_ch"])
+            queue.finish(job["id"], "done" if done else "queued")
+        except KeyboardInterrupt:
+            queue.finish(job["id"], "queued"); return
+        except Exception as e:
+            print(f"\n❌ 任务 #{job['id']} 失败: {e}")
+            queue.finish(job["id"], "failed", str(e)[:200])
+            unlock_book(folder_path)
+        finally:
+            claimed.discard(folder_path)
+            leave_lane()
+
+def run_daemon(workers):
+    """🌙 无人值守：持续从任务队列取活，定期扫描新书、回收失联任务，不需要任何终端交互"""
+    queue = JobQueue()
+    log(f"🌙 守护模式启动：{workers} 个工位 | 每 {DAEMON_POLL_SECONDS} 秒扫描新书 | 任务库 {queue.db_path}")
+    discover_books(queue)
+    queue.requeue_orphans()
+    claimed = set()
+    threads = []
+    for worker_id in range(1, workers + 1):
+        t = threading.Thread(target=daemon_worker, args=(worker_id, queue, claimed), daemon=True)
+        t.start()
+        threads.append(t)
+    try:
+        while True:
+            STOP_EVENT.wait(DAEMON_POLL_SECONDS)
+            discover_books(queue)
+            queue.requeue_orphans()
+            settle_vanished_jobs(queue)
+    except KeyboardInterrupt:
+        STOP_EVENT.set()
+        engine.cancel_all()
+        print("\n👋 用户手动停止，正在释放书籍锁并把任务放回队列...")
+        for t in threads: t.join(timeout=5)
+        for book in list(claimed):
+            if os.path.isdir(book): unlock_book(book)
+        queue.requeue_orphans()
+
+def print_job_queue():
+    jobs = JobQueue().jobs()
+    if not jobs: print("📮 任务队列为空。"); return
+    icons = {"running": "🔵", "queued": "⚪", "done": "✅", "failed": "❌"}
+    print(f"📮 任务队列 ({JOB_DB})：")
+    for job in jobs:
+        span = f"第{job['start_ch']}-{job['end_ch'] or '末'}章"
+        deadline = datetime.datetime.fromtimestamp(job["deadline"]).strftime("%m-%d %H:%M") if job["deadline"] else "无"
+        extra = f" | 执行者 {job['owner']}" if job["owner"] else ""
+        if job["error"]: extra += f" | 失败 {job['attempts']} 次: {job['error'][:40]}"
+        print(f"{icons.get(job['status'], '?')} #{job['id']} {job['book']} {span} | 优先级 {job['priority']} | 截止 {deadline}{extra}")
 
 # ==========================================
-#              6. 主程序入口
+#              7. 主程序入口
 # ==========================================
 
+def build_engine(endpoints):
+    return AIEngine(endpoints, max_inflight=MAX_INFLIGHT_CALLS,
+                    per_model_limit=MAX_INFLIGHT_PER_MODEL, progress_interval=15,
+                    endpoint_rpm=ENDPOINT_RPM, model_rpm=MODEL_RPM)
+
 def init_client_dynamic():
-    global client
+    global engine
     print("\n🔐 --- 身份验证 ---")
+    multi = False
     if os.path.exists(CONFIG_FILE):
         try:
             with open(CONFIG_FILE, "r", encoding="utf-8") as f:
                 cfg = json.load(f)
-                client = OpenAI(api_key=cfg['api_key'], base_url=cfg['base_url'])
-            print("✅ 已自动登录。")
+            multi = "endpoints" in cfg
+            endpoints = load_endpoints(cfg)
+            engine = build_engine(endpoints)
+            if len(endpoints) > 1:
+                print(f"✅ 已自动登录 ({len(endpoints)} 个网关负载均衡: {', '.join(ep.name for ep in endpoints)})。")
+            else:
+                print("✅ 已自动登录。")
             return
-        except: pass
+        except Exception as e:
+            print(f"⚠️ 配置文件读取失败: {e}")
 
     api_key = input("请输入 API Key: ").strip()
     while not api_key: api_key = input("请输入 API Key: ").strip()
     default_url = "http://172.96.160.216:3000/v1"
     base_url = input(f"Base URL (回车默认 {default_url}): ").strip() or default_url
-    client = OpenAI(api_key=api_key, base_url=base_url)
+    engine = build_engine([Endpoint(api_key, base_url)])
+    if multi: return  # 手写的多网关配置有误时不覆盖，改好后下次自动生效
     try:
         with open(CONFIG_FILE, "w", encoding="utf-8") as f:
             json.dump({"api_key": api_key, "base_url": base_url}, f)
     except: pass
 
-def main_writer():
-    global CHAPTERS_WRITTEN_SESSION, SESSION_START_TIME
+def write_chapters(folder_path, bible, manifest, first_chapter=1, last_chapter=None):
+    """✍️ 按顺序写第 first_chapter~last_chapter 章 (已写的跳过)。写完返回 True，中途停下返回 None (由调用方解锁)。
+    从中间某章起写时，前一章已写就接着真实前文，否则用分卷交接状态 (handoffs/N.json) 开篇"""
+    book_name = folder_path.replace("Book_", "").split("_")[-1]
+    outlines, outline_meta = load_outline(folder_path)
+    requested_last = last_chapter
+    total_chapters = planned_chapters(outlines, outline_meta)
+    last_chapter = min(requested_last or total_chapters, total_chapters)
+    
+    prev_summary = "故事开始。"
+    prev_tail = "无"
+    restored = False
+    handoff_chapter = None  # 按推演状态开篇的章节，落盘时记进日志，留给接缝修整
+    book_memory = BookMemory(folder_path)  # 摘要库/汇总只读这一次，之后每章追读新增的行
+    summaries = book_memory.summaries
+    if first_chapter > 1:
+        prev = manifest.get(first_chapter - 1)
+        if prev and prev["size"] > 100:
+            prev_tail = read_tail(manifest.chapter_path(first_chapter - 1), 500) or "无"
+            prev_summary = lookup_summary(summaries, first_chapter - 1, prev["hash"])
+            restored = prev_summary is not None
+        else:
+            handoff = load_handoff(folder_path, first_chapter) or {"summary": "新的一卷开始。"}
+            prev_summary = f"【新卷开篇·前情推演】{handoff['summary']}"
+            prev_tail = "无 (新卷开篇)"
+            handoff_chapter = first_chapter
+    session_start = time.time()
+    chapters_written = 0
+
+    # 🔥 流水线：标题/审计/摘要 三路并发；摘要一出就提前构思下一章反转
+    pipeline = StageScheduler()
+    pending_assets = None
+    pending_summary = None
+    pending_entities = None
+    pending_twist = None  # (章节号, future)
+    
+    try:
+        chapter_num = first_chapter - 1
+        while chapter_num < last_chapter:
+            if STOP_EVENT.is_set():
+                log("🛑 收到停止信号，本书暂停。"); return
+            if lease_lost(folder_path):
+                log("🛑 写作锁已被其它工位接管，本书交给对方继续。"); return
+            chapter_num += 1
+            i = chapter_num - 1
+            # 细纲还在分卷生成：追上了就等，细纲收尾后按实际章数校正范围
+            if chapter_num > len(outlines) and not outline_complete(outline_meta):
+                refreshed = wait_for_outline(folder_path, chapter_num)
+                if refreshed is None: return
+                outlines, outline_meta = refreshed
+                book_memory.volumes = book_volumes(folder_path)
+                total_chapters = planned_chapters(outlines, outline_meta)
+                last_chapter = min(requested_last or total_chapters, total_chapters)
+                if chapter_num > last_chapter: break
+            line_content = outlines[i]
+            set_terminal_title(f"✍️ {book_name} | {chapter_num}/{total_chapters}")
+            file_name = f"{folder_path}/chapters/第{chapter_num}章.txt"
+            
+            done_ch, done_words, left_ch, est_left_words = calculate_book_stats(manifest, total_chapters)
+            eta_str = calculate_eta(total_chapters, i, session_start, chapters_written)
+            progress_bar = get_progress_bar(done_ch, total_chapters)
+            
+            print("\n" + "="*55)
+            print(f"📊 [奥特曼全息看板] 书名：《{book_name}》")
+            print(f"📈 整体进度: {progress_bar}")
+            print(f"✅ 已完结: {done_ch} 章  (实测: {done_words} 字)")
+            print(f"⏳ 待撰写: {left_ch} 章  (预估: {est_left_words} 字)")
+            print(f"⏱️ 完本 ETA: {eta_str}")
+            print("="*55)
+            
+            # 上一章的审计和摘要必须先落地，本章才能开写
+            if pending_assets: pending_assets.result(); pending_assets = None
+            if pending_entities: pending_entities.result(); pending_entities = None
+            if pending_summary: prev_summary = pending_summary.result(); pending_summary = None
+            assets_data = render_assets(ledger_before(folder_path, chapter_num))
+
+            twist_future = None
+            if pending_twist and pending_twist[0] == chapter_num: twist_future = pending_twist[1]
+            pending_twist = None
+
+            entry = manifest.get(chapter_num)
+            if entry:
+                if entry["size"] > 100: 
+                    print(f"[第{chapter_num}章] ✅ 已完成，跳过...")
+                    prev_tail = read_tail(file_name, 500) or "无"
+                    prev_summary = lookup_summary(summaries, chapter_num, entry["hash"])
+                    restored = prev_summary is not None
+                    continue
+                else: print(f"[第{chapter_num}章] ⚠️ 检测到文件损坏，准备重写...")
+            
+            # 续写点：摘要库里没有上一章的有效摘要，就现场补一份
+            if prev_summary is None:
+                log(f"📚 摘要库缺少第 {chapter_num - 1} 章摘要，正在补写...")
+                prev_body = chapter_body(read_file(manifest.chapter_path(chapter_num - 1)))
+                prev_summary = summarize_and_store(folder_path, chapter_num - 1, prev_body)
+            elif restored:
+                log(f"📚 已从摘要库恢复第 {chapter_num - 1} 章前情。")
+            restored = False
+
+            # 1. 生成正文 (带反转)
+            is_final = outline_complete(outline_meta) and chapter_num == total_chapters
+            twist = twist_future.result() if twist_future else None
+            partial_path = f"{folder_path}/chapters/第{chapter_num}章.partial"
+            assets_view, context = build_chapter_context(folder_path, chapter_num, manifest, book_memory, bible, line_content, prev_summary, prev_tail, assets_data)
+            content = generate_chapter_robust(chapter_num, line_content, prev_summary, prev_tail, bible, is_final, assets_view, twist, partial_path, context=context)
+            
+            # 2. 正文完成后：标题 / 审计 / 摘要 并发 (合并模式下一次请求全拿到)
+            print(f"    └── 🎣 正在生成爆款SEO标题 | 🤖 审计资产变化 | 📝 提炼摘要...")
+            old_title = line_content.strip()
+            if FUSED_POSTPROCESS:
+                pending_assets = pipeline.submit(postprocess_chapter_fused, folder_path, chapter_num, content, old_title)
+                title_future = pipeline.submit(lambda post: post["title"], after={"post": pending_assets})
+                pending_summary = pipeline.submit(lambda post: post["summary"], after={"post": pending_assets})
+                pending_entities = pipeline.submit(lambda folder, n, text, post: update_entities(folder, n, text, post["entities"]),
+                                                   folder_path, chapter_num, content, after={"post": pending_assets})
+            else:
+                title_future = pipeline.submit(generate_seo_title, content, old_title)
+                pending_assets = pipeline.submit(update_assets, folder_path, chapter_num, content)
+                pending_summary = pipeline.submit(summarize_and_store, folder_path, chapter_num, content)
+                pending_entities = pipeline.submit(update_entities, folder_path, chapter_num, content)
+            if chapter_num < min(last_chapter, len(outlines)):
+                pending_twist = (chapter_num + 1, pipeline.submit(
+                    design_twist, chapter_num + 1, outlines[i + 1], after={"prev_summary": pending_summary}))
+
+            # 3. 保存 (只依赖标题)
+            seo_title = title_future.result()
+            print(f"    └── 🎣 标题已优化: {old_title} -> {seo_title}")
+            final_content = f"第 {chapter_num} 章 {seo_title}\n\n{content}"
+            if lease_lost(folder_path):
+                log(f"🛑 写作锁已被其它工位接管，第 {chapter_num} 章不落盘，交给对方重写。"); return
+            atomic_write(file_name, final_content)
+            if chapter_num == handoff_chapter:
+                record_stage(folder_path, chapter_num, "text", hash=content_hash(content), handoff=True)
+            else:
+                record_stage(folder_path, chapter_num, "text", hash=content_hash(content))
+            manifest.record(chapter_num, final_content)
+            if os.path.exists(partial_path): os.remove(partial_path)
+            
+            chapters_written += 1
+            prev_tail = content[-500:]
+            log(f"✅ 第 {chapter_num} 章完稿！")
+    finally:
+        pipeline.close()
+    return True
+
+def write_volumes_parallel(folder_path, bible, manifest, volumes, first_chapter=1, last_chapter=None):
+    """🧵 分卷并行：每卷一个线程同时写。前一卷还没写到的卷，先推演交接状态再开篇；
+    推演失败的卷退回串行，等前一卷写完再接着写。全部写完返回 True，有卷中途停下返回 None"""
+    spans = [(k, name, max(start, first_chapter), min(end, last_chapter or end)) for k, name, start, end in volumes]
+    spans = [span for span in spans if span[2] <= span[3]]
+    written = lambda n: (manifest.get(n) or {}).get("size", 0) > 100
+    book_name = folder_path.replace("Book_", "").split("_")[-1]
+    lane_name, log_path = current_lane() or (book_name, os.path.join(folder_path, "writer.log"))
+    if not isinstance(sys.stdout, LaneConsole): sys.stdout = LaneConsole(sys.stdout)
+    log(f"🧵 分卷并行：{len(spans)} 卷同时开写 ({' / '.join(f'{name} 第{s}-{e}章' for _, name, s, e in spans)})")
+
+    def run_volume(k, name, start, end, previous):
+        enter_lane(f"{lane_name}·第{k}卷", log_path)
+        try:
+            if start > 1 and not written(start - 1) and not written(start):
+                outlines, meta = load_outline(folder_path)
+                if len(outlines) < start and not outline_complete(meta):
+                    refreshed = wait_for_outline(folder_path, start)
+                    if refreshed is None: return None
+                    outlines = refreshed[0]
+                if not synthesize_handoff(folder_path, start, name, bible, outlines):
+                    log(f"⚠️ 【{name}】交接状态推演失败，等上一卷写完再接着写。")
+                    if previous is None or not previous.result(): return None
+            return write_chapters(folder_path, bible, manifest, start, end)
+        finally:
+            leave_lane()
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=len(spans)) as pool:
+        for k, name, start, end in spans:
+            futures.append(pool.submit(run_volume, k, name, start, end, futures[-1] if futures else None))
+    return all(f.result() for f in futures) or None
+
+def write_book(folder_path, first_chapter=1, last_chapter=None):
+    """✍️ 单本书的完整写作流程 (调用方负责加锁)。
+    first_chapter / last_chapter：本次负责的章节范围 (任务队列按章节范围派活)；写完指定范围返回 True，中途停下返回 None"""
+    book_name = folder_path.replace("Book_", "").split("_")[-1]
+    set_terminal_title(f"🚀 准备中: {book_name}")
+    recover_book(folder_path)
+    
+    bible = read_file(f"{folder_path}/bible.txt")
+    outlines, outline_meta = load_outline(folder_path)
+    if not bible or not (outlines or not outline_complete(outline_meta)):
+        print("❌ 资料缺失！请检查 outline.txt 是否为空。"); unlock_book(folder_path); return
+
+    manifest = BookManifest(folder_path)
+    volumes = book_volumes(folder_path) if VOLUME_PARALLEL else []
+    if len(volumes) > 1:
+        done = write_volumes_parallel(folder_path, bible, manifest, volumes, first_chapter, last_chapter)
+    else:
+        if VOLUME_PARALLEL: log("ℹ️ 本书没有分卷信息 (outline_meta.json)，按顺序写。")
+        done = write_chapters(folder_path, bible, manifest, first_chapter, last_chapter)
+    if not done: unlock_book(folder_path); return
+    reconcile_volume_seams(folder_path)
+
+    outlines, outline_meta = load_outline(folder_path)
+    total_chapters = planned_chapters(outlines, outline_meta)
+    missing = [n for n in range(1, total_chapters + 1) if (manifest.get(n) or {}).get("size", 0) <= 100]
+    if missing or not outline_complete(outline_meta):
+        log(f"🏁 已写完本次任务范围，全书还差 {len(missing)} 章，留给后续任务。")
+        unlock_book(folder_path); return True
+    generate_marketing_intro(folder_path, bible, "\n".join(outlines))
+    mark_book_as_finished(folder_path, total_chapters)
+    return True
+
+def backfill_summaries(books):
+    """📚 为已写章节补齐摘要库 (并发调用，已有且哈希一致的章节跳过)"""
+    for folder_path in books:
+        if not os.path.isdir(os.path.join(folder_path, "chapters")): continue
+        summaries = load_summaries(folder_path)
+        manifest = BookManifest(folder_path)
+        jobs = []
+        for num, entry in sorted(manifest.chapters.items()):
+            if entry["size"] <= 100: continue
+            if lookup_summary(summaries, num, entry["hash"]) is None:
+                jobs.append((num, chapter_body(read_file(manifest.chapter_path(num)))))
+        if not jobs:
+            log(f"✅ {folder_path} 摘要库已完整。"); continue
+        log(f"📚 {folder_path}: 需补写 {len(jobs)} 章摘要...")
+        with ThreadPoolExecutor(max_workers=MAX_INFLIGHT_CALLS) as pool:
+            results = pool.map(lambda job: summarize_and_store(folder_path, *job), jobs)
+            failed = sum(1 for r in results if r == SUMMARY_FAILED)
+        log(f"✅ {folder_path}: 补写完成 {len(jobs) - failed} 章，失败 {failed} 章。")
+
+def claim_next_book(claimed):
+    """🎫 从空闲书籍中认领下一本 (同进程内串行认领，避免两个工位抢同一本)"""
+    with CLAIM_LOCK:
+        all_books = [d for d in os.listdir('.') if os.path.isdir(d) and d.startswith("Book_")]
+        all_books.sort(reverse=True)
+        for book in all_books:
+            if book in claimed or is_locked(book): continue
+            if not lock_book(book): continue  # 别的主机/进程抢先一步
+            claimed.add(book)
+            return book
+    return None
+
+def book_worker(worker_id, claimed):
+    """🏭 写作工位：不断认领空闲书籍并写完，直到没有可写的书"""
+    while not STOP_EVENT.is_set():
+        folder_path = claim_next_book(claimed)
+        if not folder_path:
+            log(f"🏁 工位{worker_id} 已无空闲书籍，下班。"); return
+        book_name = folder_path.replace("Book_", "").split("_")[-1]
+        log(f"🔒 工位{worker_id} 已锁定项目：{folder_path} (日志: {folder_path}/writer.log)")
+        enter_lane(f"工位{worker_id}·{book_name}", os.path.join(folder_path, "writer.log"))
+        try:
+            write_book(folder_path)
+        except KeyboardInterrupt:
+            return
+        except Exception as e:
+            print(f"\n❌ 致命错误: {e}")
+            unlock_book(folder_path)
+        finally:
+            leave_lane()
+
+def run_worker_pool(workers):
+    """🏭 多书并行：workers 个工位同时写不同的书，API 并发受 MAX_INFLIGHT_CALLS 统一约束"""
+    log(f"🏭 并行模式启动：{workers} 个工位 | 全局 API 并发上限 {MAX_INFLIGHT_CALLS}")
+    claimed = set()
+    threads = []
+    for worker_id in range(1, workers + 1):
+        t = threading.Thread(target=book_worker, args=(worker_id, claimed), daemon=True)
+        t.start()
+        threads.append(t)
+    try:
+        while any(t.is_alive() for t in threads):
+            for t in threads: t.join(timeout=1)
+    except KeyboardInterrupt:
+        STOP_EVENT.set()
+        engine.cancel_all()
+        print("\n👋 用户手动停止，正在释放所有书籍锁...")
+        for book in claimed:
+            if os.path.isdir(book): unlock_book(book)
+
+def main_writer(workers=None, backfill=None, daemon=False):
     try:
         print_brand_header()
         recover_zombie_books()
+        if daemon and not os.path.exists(CONFIG_FILE):
+            print(f"❌ 守护模式不能交互输入 Key，请先准备好 {CONFIG_FILE}。"); return
         init_client_dynamic()
+
+        if daemon:
+            sys.stdout = LaneConsole(sys.stdout)
+            run_daemon(workers or 1)
+            return
+
+        if backfill is not None:
+            books = backfill or sorted(d for d in os.listdir('.') if os.path.isdir(d) and d.startswith("Book_"))
+            backfill_summaries(books)
+            return
         
+        if workers:
+            sys.stdout = LaneConsole(sys.stdout)
+            run_worker_pool(workers)
+            print_brand_end()
+            return
+
         all_books = [d for d in os.listdir('.') if os.path.isdir(d) and d.startswith("Book_")]
         all_books.sort(reverse=True)
         if not all_books: print("❌ 没有找到待写书籍！"); return
@@ -478,8 +2171,7 @@ def main_writer():
         available_books = []
         print("\n📚 待写书籍列表：")
         for i, book in enumerate(all_books):
-            status = "🟢 空闲"
-            if is_locked(book): status = "🔴 锁定中"
+            status = describe_lock(book)
             print(f"[{i+1}] {status} : {book}")
             if not is_locked(book): available_books.append(book)
         
@@ -495,92 +2187,88 @@ def main_writer():
                 target_book = all_books[int(choice)-1]
                 if is_locked(target_book):
                     if input("⚠️ 强制接管？(y/n): ").lower() != 'y': return
-                    unlock_book(target_book)
+                    unlock_book(target_book, force=True)
                 folder_path = target_book
             else: return
 
-        book_name = folder_path.replace("Book_", "").split("_")[-1]
-        set_terminal_title(f"🚀 准备中: {book_name}")
-        lock_book(folder_path)
+        if not lock_book(folder_path):
+            print(f"❌ {folder_path} 刚被其它工位抢先锁定。"); return
         print(f"\n🔒 已锁定项目：{folder_path}")
-        rollback_latest_chapter(folder_path)
-        init_assets_file(folder_path)
-        
-        bible = read_file(f"{folder_path}/bible.txt")
-        outline_raw = read_file(f"{folder_path}/outline.txt")
-        if not bible or not outline_raw:
-            print("❌ 资料缺失！请检查 outline.txt 是否为空。"); unlock_book(folder_path); return
-            
-        outlines = [line.strip() for line in outline_raw.split('\n') if line.strip()]
-        total_chapters = len(outlines)
-        
-        prev_summary = "故事开始。"
-        prev_tail = "无"
-        SESSION_START_TIME = time.time()
-        CHAPTERS_WRITTEN_SESSION = 0
-        
-        for i, line_content in enumerate(outlines):
-            chapter_num = i + 1
-            set_terminal_title(f"✍️ {book_name} | {chapter_num}/{total_chapters}")
-            file_name = f"{folder_path}/chapters/第{chapter_num}章.txt"
-            
-            done_ch, done_words, left_ch, est_left_words = calculate_book_stats(folder_path, total_chapters)
-            eta_str = calculate_eta(total_chapters, i)
-            progress_bar = get_progress_bar(done_ch, total_chapters)
-            
-            print("\n" + "="*55)
-            print(f"📊 [奥特曼全息看板] 书名：《{book_name}》")
-            print(f"📈 整体进度: {progress_bar}")
-            print(f"✅ 已完结: {done_ch} 章  (实测: {done_words} 字)")
-            print(f"⏳ 待撰写: {left_ch} 章  (预估: {est_left_words} 字)")
-            print(f"⏱️ 完本 ETA: {eta_str}")
-            print("="*55)
-            
-            assets_data = read_file(f"{folder_path}/assets.txt")
-
-            if os.path.exists(file_name):
-                if os.path.getsize(file_name) > 100: 
-                    print(f"[第{chapter_num}章] ✅ 已完成，跳过...")
-                    content = read_file(file_name)
-                    prev_tail = content[-500:] if content else "无"
-                    continue
-                else: print(f"[第{chapter_num}章] ⚠️ 检测到文件损坏，准备重写...")
-            
-            # 1. 生成正文 (带反转)
-            is_final = (chapter_num == total_chapters)
-            content = generate_chapter_robust(chapter_num, line_content, prev_summary, prev_tail, bible, is_final, assets_data)
-            
-            # 2. 生成SEO标题
-            print(f"    └── 🎣 正在生成爆款SEO标题...", end="\r")
-            old_title = line_content.strip()
-            seo_title = generate_seo_title(content, old_title)
-            print(f"    └── 🎣 标题已优化: {old_title} -> {seo_title}")
-            
-            # 3. 保存
-            final_content = f"第 {chapter_num} 章 {seo_title}\n\n{content}"
-            with open(file_name, "w", encoding="utf-8") as f: f.write(final_content)
-            
-            CHAPTERS_WRITTEN_SESSION += 1
-            prev_tail = content[-500:]
-            
-            # 4. 审计
-            print(f"    └── 🤖 正在审计本章资产变化...", end="\r")
-            update_assets(folder_path, content)
-            
-            prev_summary = summarize_chapter(content)
-            log(f"✅ 第 {chapter_num} 章完稿！")
-            time.sleep(3)
-
-        generate_marketing_intro(folder_path, bible, outline_raw)
-        mark_book_as_finished(folder_path, total_chapters)
+        write_book(folder_path)
         print_brand_end() 
 
     except KeyboardInterrupt:
         print("\n👋 用户手动停止")
+        if engine: engine.cancel_all()
         if 'folder_path' in locals() and folder_path: unlock_book(folder_path)
     except Exception as e:
         print(f"\n❌ 致命错误: {e}")
         if 'folder_path' in locals() and folder_path: unlock_book(folder_path)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="奥特曼写作引擎")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="并行写作的书籍数量 (不填则进入交互选书模式)")
+    parser.add_argument("--max-inflight", type=int, default=MAX_INFLIGHT_CALLS,
+                        help=f"全局同时在途的 AI 请求上限 (默认 {MAX_INFLIGHT_CALLS})")
+    parser.add_argument("--rpm", type=int, default=ENDPOINT_RPM,
+                        help=f"本机所有进程合计每分钟请求网关的上限 (默认 {ENDPOINT_RPM})")
+    parser.add_argument("--model-rpm", type=int, default=MODEL_RPM,
+                        help=f"本机所有进程合计每分钟请求单个模型的上限 (默认 {MODEL_RPM})")
+    parser.add_argument("--fused", action="store_true",
+                        help="章节后处理合并为一次请求 (标题+摘要+档案，返回 JSON，校验失败退回分开调用)")
+    parser.add_argument("--volume-parallel", action="store_true",
+                        help="分卷并行：一本书的各卷同时写 (后面的卷先推演交接状态，写完后自动修整接缝)")
+    parser.add_argument("--context-budget", type=int, default=CONTEXT_TOKEN_BUDGET, metavar="TOKENS",
+                        help=f"每章上下文 (档案+设定+分层前情) 的预算，按估算 token 计 (默认 {CONTEXT_TOKEN_BUDGET})")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="不读写 Flash 副任务的响应缓存 (~/.cache/ultraman/cache.db)，全部重新请求")
+    parser.add_argument("--no-library-index", action="store_true",
+                        help="不维护全库检索索引 (~/.cache/ultraman/library_*.db)，之后用 5_search_library.py 查询时再补")
+    parser.add_argument("--stream", action="store_true",
+                        help="正文流式生成：实时显示字数/速度，断点稿写入 第N章.partial")
+    parser.add_argument("--stall", type=int, default=STALL_TIMEOUT_SECONDS, metavar="SECONDS",
+                        help=f"流式模式下多少秒没有新内容就判定卡死并换模型 (默认 {STALL_TIMEOUT_SECONDS})")
+    parser.add_argument("--hedge", type=int, default=HEDGE_DELAY_SECONDS, metavar="SECONDS",
+                        help="高潮/大结局章节开启对冲请求：N 秒未交稿就追加第二个 Pro 模型 (0=同时发，与 --stream 互斥)")
+    parser.add_argument("--backfill-summaries", nargs="*", metavar="BOOK", default=None,
+                        help="为已写章节补齐摘要库后退出 (不指定书籍则处理全部 Book_*)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="无人值守守护模式：持续从任务队列取活，自动发现新书 (工位数用 --workers，默认 1)")
+    parser.add_argument("--enqueue", metavar="BOOK", default=None,
+                        help="把一本书 (或其中一段章节) 加入任务队列后退出")
+    parser.add_argument("--chapters", type=parse_chapter_range, default=(1, None), metavar="A-B",
+                        help="配合 --enqueue：章节范围，例如 1-50、51- (默认整本)")
+    parser.add_argument("--priority", type=int, default=0,
+                        help="配合 --enqueue：优先级，越大越先写 (默认 0)")
+    parser.add_argument("--deadline", type=parse_deadline, default=None, metavar="'YYYY-MM-DD HH:MM'",
+                        help="配合 --enqueue：截止时间，同优先级下越早越先写")
+    parser.add_argument("--jobs", action="store_true", help="查看任务队列后退出")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    main_writer()
\ No newline at end of file
+    args = parse_args()
+    MAX_INFLIGHT_CALLS = max(1, args.max_inflight)
+    HEDGE_DELAY_SECONDS = args.hedge
+    if args.stream and args.hedge is not None:
+        print("⚠️ 对冲请求不支持流式 (没有断点稿和卡死看门狗)：--stream 下忽略 --hedge，高潮章按顺序调用 Pro 模型。")
+        HEDGE_DELAY_SECONDS = None
+    ENDPOINT_RPM = max(1, args.rpm)
+    MODEL_RPM = max(1, args.model_rpm)
+    STREAM_MODE = args.stream
+    USE_RESPONSE_CACHE = not args.no_cache
+    FUSED_POSTPROCESS = args.fused
+    VOLUME_PARALLEL = args.volume_parallel
+    LIBRARY_INDEX = not args.no_library_index
+    CONTEXT_TOKEN_BUDGET = max(1000, args.context_budget)
+    STALL_TIMEOUT_SECONDS = args.stall
+    if args.enqueue:
+        book = args.enqueue.rstrip("/")
+        if not os.path.isdir(book): sys.exit(f"❌ 找不到书籍目录：{book}")
+        start, end = args.chapters
+        job_id = JobQueue().enqueue(book, start, end, args.priority, args.deadline)
+        print(f"📮 已入队 #{job_id}：{book} 第{start}-{end or '末'}章 | 优先级 {args.priority}")
+    elif args.jobs:
+        print_job_queue()
+    else:
+        main_writer(workers=args.workers, backfill=args.backfill_summaries, daemon=args.daemon)
@@ -41,7 +41,7 @@ def fix_books():
             continue
             
         # 遍历所有章节文件
-        files = os.listdir(chapters_dir)
+        files = [f for f in os.listdir(chapters_dir) if f.endswith(".txt")]  # 跳过 .partial 断点稿
         files.sort(key=lambda x: int(x.replace("第", "").replace("章.txt", "")) if "第" in x else 0)
         
         for file_name in files:
@@ -1,6 +1,7 @@
 import os
 import re
 import datetime # 🔥 新增引入
+from library_index import LibraryIndex
 
 def print_brand():
     print(r"""
@@ -135,6 +136,13 @@ def merge_books():
             except Exception as e:
                 print(f"   ⚠️ 改名失败: {e}")
 
+    # 🔎 打包会重写章节标题、给文件夹改名，全库检索索引跟着增量同步
+    try:
+        stats = LibraryIndex().sync()
+        print(f"\n🔎 检索索引已同步：重建 {stats['indexed']} 章，改标题 {stats['retitled']} 章，改名 {stats['renamed']} 本")
+    except Exception as e:
+        print(f"\n⚠️ 检索索引同步失败 (不影响打包，下次检索时会自动补): {e}")
+
     print("\n" + "="*60)
     print("🎉 所有新书打包完毕！")
     print("="*60)
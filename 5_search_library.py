@@ -0,0 +1,58 @@
+import argparse
+import sys
+import time
+from library_index import LibraryIndex
+
+def print_brand():
+    print(r"""
+    ****************************************************
+    * 🔎 奥特曼全库检索机 (Library Search)          *
+    * Ultraman Airdrop Research Institute       *
+    ****************************************************
+    """)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="在当前目录下所有书 (Book_* / 【已完结】_* / 【已打包】_*) 的章节里检索短语")
+    parser.add_argument("phrases", nargs="*", help="要检索的短语 (至少两个字)，可以给多个")
+    parser.add_argument("--book", help="只查书名里包含这个关键字的书")
+    parser.add_argument("--limit", type=int, default=50, help="每个短语最多列出多少处命中 (默认 50，0 = 不限)")
+    parser.add_argument("--context", type=int, default=20, help="命中前后各带多少字上下文 (默认 20)")
+    parser.add_argument("--no-sync", action="store_true", help="查询前不做增量同步 (直接查现有索引)")
+    parser.add_argument("--rebuild", action="store_true", help="删掉旧索引，全库重建")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if not args.phrases and not args.rebuild:
+        print("❌ 请给出要检索的短语，例如：python 5_search_library.py \"龙傲天\"")
+        sys.exit(1)
+    print_brand()
+
+    index = LibraryIndex()
+    if args.rebuild:
+        index.drop_all()
+        print("🧹 已清空旧索引，开始全库重建...")
+    if args.rebuild or not args.no_sync:
+        t0 = time.time()
+        stats = index.sync()
+        if stats["indexed"] or stats["retitled"] or stats["renamed"] or stats["dropped"]:
+            print(f"🔄 索引同步：{stats['books']} 本书，重建 {stats['indexed']} 章，改标题 {stats['retitled']} 章，"
+                  f"改名 {stats['renamed']} 本，移除 {stats['dropped']} 章 ({time.time() - t0:.2f}s)")
+    summary = index.stats()
+    print(f"📚 索引规模：{summary['books']} 本书 · {summary['chapters']} 章 · {summary['postings']} 条倒排\n")
+
+    for phrase in args.phrases:
+        t0 = time.time()
+        try: hits = index.search(phrase, book=args.book, limit=args.limit or None, context=args.context)
+        except ValueError as e:
+            print(f"⚠️ 「{phrase}」: {e}")
+            continue
+        elapsed = (time.time() - t0) * 1000
+        print(f"-"*60)
+        print(f"🔍 「{phrase}」: {len(hits)} 处命中{' (已截断)' if args.limit and len(hits) >= args.limit else ''} ({elapsed:.1f}ms)")
+        for hit in hits:
+            print(f"   📖 {hit['book']} | 第 {hit['chapter']} 章 | 偏移 {hit['offset']}")
+            print(f"      {hit['snippet']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import time
+
+# ==========================================
+#     📚 全库全文索引 (SQLite 倒排表，汉字二元组)
+# ==========================================
+# 一章 = 一个文档，按相邻两字 (二元组) 建倒排表；查询时先用最稀有的几个二元组求交集，
+# 再打开候选章节逐字核对，给出 书/章/字符偏移。只存“哪章出现过哪个二元组”，不存位置，索引很小。
+# 按文件大小 + 修改时间增量更新：没变的章节不重建；书籍改名 (完结/打包) 按正文指纹认出来，只改书名；
+# 打包机/修复工具只改写开头的标题行，正文指纹不变，只增删标题行带来的二元组，不整章重建。
+
+# 索引库是本机文件 (~/.cache/ultraman/library_<书库路径哈希>.db，和写作机的任务队列同一规则)：
+# SQLite 的 WAL 不能跨主机在网络盘上共用，多台主机共享书库时各自维护一份，查询前按磁盘增量补齐
+STATE_DIR = os.environ.get("ULTRAMAN_STATE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "ultraman")
+BOOK_PREFIXES = ("Book_", "【已完结】_", "【已打包】_")
+MAX_QUERY_GRAMS = 8         # 求交集只用最稀有的这么多个二元组，剩下的交给逐字核对
+HEADER_LINE = re.compile(r'第\s*\d+\s*章.*')
+
+def library_db_path(root="."):
+    """本机索引库路径 (按书库绝对路径区分；建不了状态目录就退到系统临时目录)"""
+    name = f"library_{hashlib.sha1(os.path.abspath(root).encode('utf-8')).hexdigest()[:10]}.db"
+    for folder in (STATE_DIR, os.path.join(tempfile.gettempdir(), "ultraman")):
+        try:
+            os.makedirs(folder, exist_ok=True)
+            return os.path.join(folder, name)
+        except OSError: continue
+    return name
+
+def book_folders(root="."):
+    if not os.path.isdir(root): return []
+    return sorted(d for d in os.listdir(root)
+                  if d.startswith(BOOK_PREFIXES) and os.path.isdir(os.path.join(root, d)))
+
+def chapter_files(folder_path):
+    """{章节号: 路径}"""
+    chapters_dir = os.path.join(folder_path, "chapters")
+    if not os.path.isdir(chapters_dir): return {}
+    files = {}
+    for f in os.listdir(chapters_dir):
+        match = re.fullmatch(r'第(\d+)章\.txt', f)
+        if match: files[int(match.group(1))] = os.path.join(chapters_dir, f)
+    return files
+
+def bigrams(text):
+    """相邻两字一组 (跨空白不算)，英文不区分大小写"""
+    text = text.lower()
+    return {text[i:i + 2] for i in range(len(text) - 1)
+            if not text[i].isspace() and not text[i + 1].isspace()}
+
+def split_chapter(text):
+    """(开头的章节标题行, 正文)：打包机会把 "第 N 章 标题" 改写成 "第 N 章：标题" 或在上面再叠一行，正文不动。
+    二元组不跨换行，所以 全文二元组 = 标题部分 ∪ 正文部分"""
+    lines = text.split("\n")
+    i = 0
+    while i < len(lines) and (not lines[i].strip() or HEADER_LINE.fullmatch(lines[i].strip())): i += 1
+    return "\n".join(lines[:i]), "\n".join(lines[i:])
+
+def body_hash(body):
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+def read_text(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f: return f.read()
+    except: return None
+
+def snippet(text, offset, length, context):
+    start, end = max(0, offset - context), min(len(text), offset + length + context)
+    clip = text[start:end].replace("\n", " ")
+    return ("…" if start > 0 else "") + clip + ("…" if end < len(text) else "")
+
+class LibraryIndex:
+    """🔎 全库倒排索引：写作机每章落盘后增量登记，打包机改名后同步，检索机查询前同步"""
+    def __init__(self, root=".", db_path=None):
+        self.root = root
+        self.db_path = db_path or library_db_path(root)
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS chapters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, book TEXT NOT NULL, chapter INTEGER NOT NULL,
+                size INTEGER, mtime INTEGER, indexed REAL, UNIQUE(book, chapter))""")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(chapters)")}
+            for column in ("header", "body"):  # 老索引库补列 (正文指纹为空的章节变了就整章重建)
+                if column not in columns: conn.execute(f"ALTER TABLE chapters ADD COLUMN {column} TEXT")
+            conn.execute("""CREATE TABLE IF NOT EXISTS postings (
+                gram TEXT NOT NULL, doc INTEGER NOT NULL, PRIMARY KEY (gram, doc)) WITHOUT ROWID""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_postings_doc ON postings(doc)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _index(self, conn, book, chapter_num, path, force=False):
+        """登记一章 (大小和修改时间都没变就跳过)。返回 None (没变) / "header" (只改了标题行) / "full" (整章重建)"""
+        try: st = os.stat(path)
+        except OSError: return None
+        query = "SELECT id, size, mtime, header, body FROM chapters WHERE book=? AND chapter=?"
+        row = conn.execute(query, (book, chapter_num)).fetchone()
+        if row and not force and (row[1], row[2]) == (st.st_size, st.st_mtime_ns): return None
+        text = read_text(path)
+        if text is None: return None
+        header, body = split_chapter(text)
+        digest = body_hash(body)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(query, (book, chapter_num)).fetchone()  # 多个工位可能同时登记同一本书
+            if row and not force and (row[1], row[2]) == (st.st_size, st.st_mtime_ns):
+                conn.execute("ROLLBACK")
+                return None
+            if row and not force and row[4] == digest:
+                # 正文没动，只是标题行被改写：只增删标题行独有的二元组 (正文里也有的不能删)
+                doc, result = row[0], "header"
+                old, new = bigrams(row[3] or ""), bigrams(header)
+                if old != new:
+                    stale = old - new - bigrams(body)
+                    conn.executemany("DELETE FROM postings WHERE gram=? AND doc=?", ((g, doc) for g in stale))
+                    conn.executemany("INSERT OR IGNORE INTO postings VALUES (?, ?)", ((g, doc) for g in new - old))
+                conn.execute("UPDATE chapters SET size=?, mtime=?, header=?, indexed=? WHERE id=?",
+                             (st.st_size, st.st_mtime_ns, header, time.time(), doc))
+            else:
+                result = "full"
+                if row:
+                    doc = row[0]
+                    conn.execute("DELETE FROM postings WHERE doc=?", (doc,))
+                    conn.execute("UPDATE chapters SET size=?, mtime=?, header=?, body=?, indexed=? WHERE id=?",
+                                 (st.st_size, st.st_mtime_ns, header, digest, time.time(), doc))
+                else:
+                    doc = conn.execute("""INSERT INTO chapters (book, chapter, size, mtime, header, body, indexed)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)""", (book, chapter_num, st.st_size, st.st_mtime_ns,
+                                                          header, digest, time.time())).lastrowid
+                conn.executemany("INSERT INTO postings VALUES (?, ?)", ((g, doc) for g in bigrams(text)))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def _drop(self, conn, where, args):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(f"DELETE FROM postings WHERE doc IN (SELECT id FROM chapters WHERE {where})", args)
+            conn.execute(f"DELETE FROM chapters WHERE {where}", args)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def index_chapter(self, folder_path, chapter_num):
+        """写作机每章落盘后调用：只登记这一章"""
+        book = os.path.basename(os.path.normpath(folder_path))
+        path = os.path.join(folder_path, "chapters", f"第{chapter_num}章.txt")
+        conn = self._connect()
+        try:
+            if os.path.exists(path): return self._index(conn, book, chapter_num, path) is not None
+            self._drop(conn, "book=? AND chapter=?", (book, chapter_num))
+            return False
+        finally:
+            conn.close()
+
+    def sync(self):
+        """全库增量同步：认出改名的书 (正文指纹对得上)，更新变过的章节，删掉消失的。返回统计"""
+        stats = {"books": 0, "indexed": 0, "retitled": 0, "renamed": 0, "dropped": 0}
+        on_disk = {book: chapter_files(os.path.join(self.root, book)) for book in book_folders(self.root)}
+        conn = self._connect()
+        try:
+            known = {}
+            for book, chapter_num, digest in conn.execute("SELECT book, chapter, body FROM chapters"):
+                known.setdefault(book, {})[chapter_num] = digest
+
+            # 1. 改名：消失的书和新出现的书按各章正文指纹配对 (打包机同时会改写标题行，正文不变)
+            gone = {book: digests for book, digests in known.items() if book not in on_disk}
+            for book in [b for b in on_disk if b not in known] if gone else []:
+                digests = {}
+                for n, path in on_disk[book].items():
+                    text = read_text(path)
+                    if text is not None: digests[n] = body_hash(split_chapter(text)[1])
+                best, score = None, 0
+                for old, old_digests in gone.items():
+                    same = sum(1 for n, digest in digests.items() if old_digests.get(n) == digest)
+                    if same > score: best, score = old, same
+                if best:
+                    conn.execute("UPDATE chapters SET book=? WHERE book=?", (book, best))
+                    del gone[best]
+                    stats["renamed"] += 1
+
+            # 2. 真正消失的书，和书里已删掉的章节
+            for book in gone:
+                self._drop(conn, "book=?", (book,))
+                stats["dropped"] += len(gone[book])
+            for book, files in on_disk.items():
+                rows = conn.execute("SELECT chapter FROM chapters WHERE book=?", (book,)).fetchall()
+                for (n,) in rows:
+                    if n in files: continue
+                    self._drop(conn, "book=? AND chapter=?", (book, n))
+                    stats["dropped"] += 1
+
+            # 3. 新增/变过的章节
+            for book, files in on_disk.items():
+                stats["books"] += 1
+                for n in sorted(files):
+                    result = self._index(conn, book, n, files[n])
+                    if result == "full": stats["indexed"] += 1
+                    elif result == "header": stats["retitled"] += 1
+            return stats
+        finally:
+            conn.close()
+
+    def search(self, phrase, book=None, limit=None, context=20):
+        """短语检索：返回 [{book, chapter, offset, snippet}]，按 书 -> 章 -> 偏移 排序。offset 是章节文件里的字符偏移"""
+        grams = bigrams(phrase)
+        if not grams: raise ValueError("检索短语至少要两个字")
+        needle = phrase.lower()
+        conn = self._connect()
+        try:
+            # 最稀有的二元组先求交集，交集空了就提前结束
+            df = sorted((conn.execute("SELECT COUNT(*) FROM postings WHERE gram=?", (g,)).fetchone()[0], g) for g in grams)
+            if df[0][0] == 0: return []
+            docs = None
+            for _, g in df[:MAX_QUERY_GRAMS]:
+                ids = {r[0] for r in conn.execute("SELECT doc FROM postings WHERE gram=?", (g,))}
+                docs = ids if docs is None else docs & ids
+                if not docs: return []
+            sql = f"SELECT id, book, chapter FROM chapters WHERE id IN ({','.join('?' * len(docs))})"
+            args = list(docs)
+            if book:
+                sql += " AND book LIKE ?"
+                args.append(f"%{book}%")
+            candidates = sorted(conn.execute(sql, args).fetchall(), key=lambda r: (r[1], r[2]))
+        finally:
+            conn.close()
+
+        hits = []
+        for _, book_name, chapter_num in candidates:
+            text = read_text(os.path.join(self.root, book_name, "chapters", f"第{chapter_num}章.txt"))
+            if text is None: continue  # 索引落后于磁盘，下次同步会修正
+            lowered = text.lower()
+            offset = lowered.find(needle)
+            while offset != -1:
+                hits.append({"book": book_name, "chapter": chapter_num, "offset": offset,
+                             "snippet": snippet(text, offset, len(phrase), context)})
+                if limit and len(hits) >= limit: return hits
+                offset = lowered.find(needle, offset + len(needle))
+        return hits
+
+    def drop_all(self):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM postings")
+            conn.execute("DELETE FROM chapters")
+        finally:
+            conn.close()
+
+    def stats(self):
+        conn = self._connect()
+        try:
+            books, chapters = conn.execute("SELECT COUNT(DISTINCT book), COUNT(*) FROM chapters").fetchone()
+            grams = conn.execute("SELECT COUNT(*) FROM postings").fetchone()[0]
+            return {"books": books, "chapters": chapters, "postings": grams}
+        finally:
+            conn.close()
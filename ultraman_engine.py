@@ -0,0 +1,832 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
+import importlib.util
+import itertools
+import json
+import math
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import httpx
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+
+# ==========================================
+#     🧠 奥特曼 AI 调度引擎 (策划机/写作机共用)
+# ==========================================
+# 所有请求共用一个后台事件循环 (AsyncOpenAI)：
+#   - 全局并发上限 + 每个模型独立的并发上限
+#   - 可随时取消全部在途请求 (Ctrl-C)
+#   - 只有一个进度渲染任务，不再每个请求开一个心跳线程
+
+class EngineStopped(KeyboardInterrupt):
+    """引擎已被手动停止 (继承 KeyboardInterrupt，沿用各脚本的"用户手动停止"处理)"""
+
+class StreamInterrupted(Exception):
+    """流式生成中途失败；partial 为已收到的正文，可用于抢救/续写"""
+    def __init__(self, model, partial, reason):
+        super().__init__(reason)
+        self.model = model
+        self.partial = partial
+
+class StreamStalled(StreamInterrupted):
+    """看门狗：超过 stall_timeout 秒没有新 token"""
+
+# ==========================================
+#     🚦 跨进程限流 (SQLite 令牌桶 + 退避)
+# ==========================================
+
+# 本机状态 (限流、响应缓存) 放在本机目录：书库目录可能是多台主机共享的网络盘，SQLite WAL 不能跨主机用
+STATE_DIR = os.environ.get("ULTRAMAN_STATE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "ultraman")
+
+def local_state_path(name):
+    """本机状态文件路径 (~/.cache/ultraman/，建不了就退到系统临时目录)"""
+    for folder in (STATE_DIR, os.path.join(tempfile.gettempdir(), "ultraman")):
+        try:
+            os.makedirs(folder, exist_ok=True)
+            return os.path.join(folder, name)
+        except OSError: continue
+    return name
+
+RATE_LIMIT_DB = local_state_path("ratelimit.db")  # 同一台机器上所有写作/策划进程共享
+ENDPOINT_RPM = 60   # 每个网关每分钟请求数
+MODEL_RPM = 30      # 每个模型每分钟请求数
+BURST_SECONDS = 10  # 桶容量 = 多少秒的配额，允许短时突发
+
+# 错误类型 -> (首次退避秒数, 退避上限)；同类错误连续出现则指数翻倍
+BACKOFF_POLICY = {
+    "rate_limit": (10, 300),  # 429：网关明确喊停，退得最狠
+    "server": (5, 120),       # 5xx / 连不上：网关或上游抖动
+    "timeout": (2, 60),       # 超时：多半是模型本身慢，轻退
+}
+
+def backoff_delay(attempt, base=5, cap=120):
+    """指数退避 + 抖动 (0.5~1 倍)，避免多个进程同一时刻一起重试"""
+    return random.uniform(0.5, 1.0) * min(cap, base * 2 ** max(0, attempt - 1))
+
+def classify_error(error):
+    if isinstance(error, RateLimitError): return "rate_limit"
+    if isinstance(error, (APITimeoutError, asyncio.TimeoutError)): return "timeout"
+    if isinstance(error, APIConnectionError): return "server"
+    if isinstance(error, APIStatusError) and getattr(error, "status_code", 0) >= 500: return "server"
+    return None  # 4xx 等请求本身的问题：退避没有意义
+
+class SharedRateLimiter:
+    """🚦 令牌桶状态存在本机 SQLite 里，所有进程共用一份配额和退避期
+
+    每个 key (网关 / 模型) 一个桶；出错时按错误类型给对应 key 设置 blocked_until，
+    其它进程取令牌时同样会被挡住，整台机器一起放慢，而不是各自为战互相放大 429。
+    """
+    def __init__(self, db_path=RATE_LIMIT_DB):
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY, tokens REAL, updated REAL,
+                blocked_until REAL DEFAULT 0, failures INTEGER DEFAULT 0)""")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def try_acquire(self, specs):
+        """specs: [(key, 每分钟配额)]。全部桶都有令牌则各扣一个返回 0，否则返回还需等待的秒数"""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            wait = 0.0
+            state = {}
+            for key, rpm in specs:
+                rate, capacity = rpm / 60.0, max(1.0, rpm / 60.0 * BURST_SECONDS)
+                row = conn.execute("SELECT tokens, updated, blocked_until FROM buckets WHERE key=?", (key,)).fetchone()
+                tokens, updated, blocked_until = row if row else (capacity, now, 0)
+                tokens = min(capacity, tokens + (now - updated) * rate)
+                if blocked_until > now: wait = max(wait, blocked_until - now)
+                elif tokens < 1: wait = max(wait, (1 - tokens) / rate)
+                state[key] = tokens
+            for key, tokens in state.items():
+                if wait == 0: tokens -= 1
+                conn.execute("""INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET tokens=excluded.tokens, updated=excluded.updated""",
+                    (key, tokens, now))
+            conn.execute("COMMIT")
+            return wait
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def penalize(self, key, kind):
+        """按错误类型为 key 设置退避期，返回退避秒数"""
+        base, cap = BACKOFF_POLICY[kind]
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT failures, blocked_until FROM buckets WHERE key=?", (key,)).fetchone()
+            failures, blocked_until = (row[0] + 1, row[1]) if row else (1, 0)
+            delay = backoff_delay(failures, base, cap)
+            conn.execute("""INSERT INTO buckets (key, tokens, updated, blocked_until, failures) VALUES (?, 0, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET blocked_until=excluded.blocked_until, failures=excluded.failures""",
+                (key, time.time(), max(blocked_until, time.time() + delay), failures))
+            conn.execute("COMMIT")
+            return delay
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def reward(self, keys):
+        """成功一次就清零连续失败计数"""
+        conn = self._connect()
+        try:
+            conn.executemany("UPDATE buckets SET failures=0 WHERE key=? AND failures>0", [(k,) for k in keys])
+        finally:
+            conn.close()
+
+# ==========================================
+#     🗃️ 响应缓存 (内容寻址，SQLite)
+# ==========================================
+# 反转构思 / 摘要 / 拟题 / 资产审计这类 Flash 副任务，输入一样就直接复用上次的结果：
+# 回滚、崩溃重启、重跑时已经做过的副任务不再花一次 API 调用。
+
+RESPONSE_CACHE_DB = local_state_path("cache.db")  # 同一台机器上所有进程共享，不放进共享书库目录
+CACHE_TTL_DAYS = 30
+CACHE_MAX_MB = 200          # 超过后按最久未使用 (LRU) 淘汰
+
+def cache_key(model, messages, params):
+    payload = json.dumps({"model": model, "messages": messages, "params": params},
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    def __init__(self, db_path=RESPONSE_CACHE_DB, ttl_days=CACHE_TTL_DAYS, max_mb=CACHE_MAX_MB):
+        self.db_path = db_path
+        self.ttl = ttl_days * 86400
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, model TEXT, content TEXT, size INTEGER,
+                created REAL, last_used REAL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON responses(last_used)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        try:
+            now = time.time()
+            row = conn.execute("SELECT content FROM responses WHERE key=? AND created>?",
+                               (key, now - self.ttl)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET last_used=? WHERE key=?", (now, key))
+            self.hits += 1
+            return row[0]
+        finally:
+            conn.close()
+
+    def put(self, key, model, content):
+        conn = self._connect()
+        try:
+            now = time.time()
+            size = len(content.encode("utf-8"))
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                         (key, model, content, size, now, now))
+            self._evict(conn, now)
+        finally:
+            conn.close()
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM responses WHERE created<=?", (now - self.ttl,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes: return
+        # 从最久未使用的开始删，删到上限的 90% 为止，避免每次写入都触发淘汰
+        excess = total - self.max_bytes * 0.9
+        doomed = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            doomed.append((key,))
+            excess -= size
+            if excess <= 0: break
+        conn.executemany("DELETE FROM responses WHERE key=?", doomed)
+
+# ==========================================
+#     🩺 模型健康路由 (熔断 + 自适应超时)
+# ==========================================
+
+EWMA_ALPHA = 0.2            # 平滑系数：越大越看重最近几次
+BREAKER_THRESHOLD = 3       # 连续失败几次后熔断
+BREAKER_BASE_COOLDOWN = 60  # 首次熔断时长 (秒)，每次复熔翻倍
+BREAKER_MAX_COOLDOWN = 1800
+MIN_LATENCY_SAMPLES = 3     # 样本太少时仍用调用方给的固定超时
+MIN_ADAPTIVE_TIMEOUT = 60  # 自适应超时的下限 (长文生成类调用)
+TIMEOUT_FLOORS = {"side": 15}  # 按调用类别另设下限：几秒就回的副任务可以收得更紧
+TIMEOUT_MARGIN = 1.5        # 超时 = p95 × 余量
+
+class LatencyStats:
+    """延迟的 EWMA 均值/方差，p95 用正态近似"""
+    def __init__(self):
+        self.latency_mean = 0.0
+        self.latency_var = 0.0
+        self.samples = 0
+
+    @property
+    def p95(self):
+        # 正态近似：p95 ≈ 均值 + 1.645σ
+        return self.latency_mean + 1.645 * math.sqrt(self.latency_var)
+
+    def observe_latency(self, seconds):
+        if self.samples == 0:
+            self.latency_mean = seconds
+        else:
+            diff = seconds - self.latency_mean
+            self.latency_mean += EWMA_ALPHA * diff
+            self.latency_var = (1 - EWMA_ALPHA) * (self.latency_var + EWMA_ALPHA * diff * diff)
+        self.samples += 1
+
+class ModelHealth(LatencyStats):
+    """整个模型的成功率 + 熔断状态；这里的延迟只用来给同梯队模型排序"""
+    def __init__(self):
+        super().__init__()
+        self.success_rate = 1.0
+        self.consecutive_failures = 0
+        self.cooldown = 0
+        self.retry_at = 0.0     # 熔断中：此时间之后才允许探活
+        self.probing = False
+
+    @property
+    def is_open(self): return self.cooldown > 0
+
+class ModelRouter:
+    """🩺 按模型记录成功率与延迟 (EWMA)，对持续失败的模型熔断，到点后放一个探活请求。
+    自适应超时另按 (模型, 调用类别) 统计：几秒的副任务和几分钟的长文生成不共用一个 p95。"""
+    def __init__(self):
+        self.health = {}
+        self.latency = {}       # (模型, 调用类别) -> LatencyStats
+        self.lock = threading.Lock()
+
+    def _get(self, model):
+        if model not in self.health: self.health[model] = ModelHealth()
+        return self.health[model]
+
+    def _observe(self, model, kind, latency):
+        self._get(model).observe_latency(latency)
+        if kind is None: return
+        self.latency.setdefault((model, kind), LatencyStats()).observe_latency(latency)
+
+    def rank(self, models):
+        """在给定梯队内按健康度排序；熔断中的模型跳过 (到点的可作为探活候选排在最后)"""
+        now = time.time()
+        with self.lock:
+            healthy, probes = [], []
+            for model in models:
+                h = self._get(model)
+                if not h.is_open: healthy.append(model)
+                elif now >= h.retry_at and not h.probing: probes.append(model)
+            healthy.sort(key=lambda m: (-round(self.health[m].success_rate, 1), self.health[m].p95))
+            return healthy + probes
+
+    def timeout_for(self, model, ceiling, kind=None):
+        """按同一类调用观测到的 p95 设定超时，不超过调用方给的上限；没标类别 (kind=None) 的调用直接用上限"""
+        if kind is None: return ceiling
+        with self.lock:
+            stats = self.latency.get((model, kind))
+            if stats is None or stats.samples < MIN_LATENCY_SAMPLES: return ceiling
+            floor = TIMEOUT_FLOORS.get(kind, MIN_ADAPTIVE_TIMEOUT)
+            return int(min(ceiling, max(floor, stats.p95 * TIMEOUT_MARGIN)))
+
+    def begin(self, model):
+        with self.lock:
+            h = self._get(model)
+            if h.is_open: h.probing = True
+
+    def release(self, model):
+        """请求被取消：不计成败，只释放探活名额"""
+        with self.lock: self._get(model).probing = False
+
+    def record_success(self, model, latency, kind=None):
+        with self.lock:
+            h = self._get(model)
+            h.success_rate += EWMA_ALPHA * (1 - h.success_rate)
+            self._observe(model, kind, latency)
+            if h.is_open: print(f"\n🩺 [探活成功] {model} 已恢复，解除熔断。")
+            h.consecutive_failures = 0
+            h.cooldown = 0
+            h.probing = False
+
+    def record_failure(self, model, latency=None, kind=None):
+        """记一次失败；latency 仅在超时时传入，让 p95 随之抬升，避免超时越设越紧"""
+        with self.lock:
+            h = self._get(model)
+            h.success_rate -= EWMA_ALPHA * h.success_rate
+            if latency is not None: self._observe(model, kind, latency)
+            h.consecutive_failures += 1
+            if h.probing or (not h.is_open and h.consecutive_failures >= BREAKER_THRESHOLD):
+                h.cooldown = min(BREAKER_MAX_COOLDOWN, h.cooldown * 2 or BREAKER_BASE_COOLDOWN)
+                h.retry_at = time.time() + h.cooldown
+                print(f"\n⚡ [熔断] {model} 连续失败 {h.consecutive_failures} 次，暂停 {h.cooldown} 秒后再探活。")
+            h.probing = False
+
+# ==========================================
+#     🔌 共享 HTTP 连接池
+# ==========================================
+# 整个进程只建一个 httpx 连接池，所有网关、所有模型 (含 Flash 小请求) 复用长连接，
+# 不再每次请求重新握手。池子大小跟着 max_inflight 走。
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None  # 装了 h2 才开 HTTP/2 多路复用
+KEEPALIVE_SECONDS = 120     # 空闲长连接保留多久
+CONNECT_TIMEOUT = 15
+POOL_HEADROOM = 4           # 在途上限之外多留几个连接 (模型列表探测、流关闭等)
+
+def build_http_client(max_inflight):
+    return httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        limits=httpx.Limits(
+            max_connections=max_inflight + POOL_HEADROOM,
+            max_keepalive_connections=max_inflight,
+            keepalive_expiry=KEEPALIVE_SECONDS,
+        ),
+        # 读超时交给每次请求自己的 timeout (自适应 p95)，这里只管连接
+        timeout=httpx.Timeout(600, connect=CONNECT_TIMEOUT),
+    )
+
+# ==========================================
+#     🌐 多网关 / 多 Key 负载均衡
+# ==========================================
+# config_key.json 可以写成：
+#   {"endpoints": [
+#       {"name": "主站", "api_key": "sk-...", "base_url": "http://.../v1", "weight": 2, "rpm": 120, "max_inflight": 6},
+#       {"name": "备用", "api_key": "sk-...", "base_url": "http://.../v1"}
+#   ]}
+# 旧格式 {"api_key": ..., "base_url": ...} 视为只有一个网关。
+
+class Endpoint:
+    def __init__(self, api_key, base_url, name=None, weight=1, rpm=None, model_rpm=None, max_inflight=None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.name = name or f"{base_url}#{api_key[-4:]}"
+        self.weight = max(0.1, float(weight))
+        self.rpm = rpm
+        self.model_rpm = model_rpm
+        self.max_inflight = max_inflight
+        self.outstanding = 0    # 已分派到本网关、尚未结束的请求数 (含排队中的)
+        self.client = None
+        self.slots = None
+
+def load_endpoints(cfg):
+    """config_key.json -> [Endpoint]；兼容旧的单 Key 格式"""
+    raw = cfg.get("endpoints") or [{"api_key": cfg.get("api_key"), "base_url": cfg.get("base_url")}]
+    endpoints = []
+    for i, item in enumerate(raw, 1):
+        if not item.get("api_key") or not item.get("base_url"):
+            raise ValueError(f"第 {i} 个网关缺少 api_key 或 base_url")
+        endpoints.append(Endpoint(
+            item["api_key"], item["base_url"], name=item.get("name"), weight=item.get("weight", 1),
+            rpm=item.get("rpm"), model_rpm=item.get("model_rpm"), max_inflight=item.get("max_inflight")
+        ))
+    if len({ep.name for ep in endpoints}) < len(endpoints): raise ValueError("网关 name 不能重复")
+    return endpoints
+
+class AIEngine:
+    def __init__(self, endpoints, max_inflight=8, per_model_limit=4,
+                 progress_interval=15, progress_title="奥特曼充能中...",
+                 endpoint_rpm=ENDPOINT_RPM, model_rpm=MODEL_RPM):
+        self.endpoints = endpoints
+        self.endpoint_rpm = endpoint_rpm
+        self.model_rpm = model_rpm
+        self.limiter = SharedRateLimiter()
+        self.cache = ResponseCache()
+        self.max_inflight = max_inflight
+        self.per_model_limit = per_model_limit
+        self.progress_interval = progress_interval
+        self.progress_title = progress_title
+        self.stopped = False
+        self.inflight = {}   # call_id -> [标签, 开始时间, 已收字数]
+        self.tasks = set()
+        self._ids = itertools.count(1)
+        self._model_slots = {}
+        self.router = ModelRouter()
+        self.endpoint_health = ModelRouter()   # 网关级熔断，复用同一套 EWMA + 熔断逻辑
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+        self._submit(self._setup()).result()
+
+    # ---------- 事件循环 ----------
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def _setup(self):
+        # 信号量/客户端必须在引擎自己的事件循环里创建
+        self.http = build_http_client(self.max_inflight)
+        for ep in self.endpoints:
+            ep.client = AsyncOpenAI(api_key=ep.api_key, base_url=ep.base_url, http_client=self.http)
+            ep.slots = asyncio.Semaphore(ep.max_inflight or self.max_inflight)
+        self._global_slots = asyncio.Semaphore(self.max_inflight)
+        self._renderer = asyncio.ensure_future(self._render_progress())
+
+    def _model_slot(self, model):
+        if model not in self._model_slots:
+            self._model_slots[model] = asyncio.Semaphore(self.per_model_limit)
+        return self._model_slots[model]
+
+    # ---------- 网关选择 / 限流 / 结果上报 ----------
+
+    def _limit_keys(self, endpoint, model):
+        return [(f"endpoint:{endpoint.name}", endpoint.rpm or self.endpoint_rpm),
+                (f"model:{endpoint.name}:{model}", endpoint.model_rpm or self.model_rpm)]
+
+    def _candidates(self, exclude=()):
+        """按 (在途数+1)/权重 从小到大排列 (加权最少在途)；熔断中的网关跳过，全熔断时仍全部可选"""
+        pool = [ep for ep in self.endpoints if ep.name not in exclude] or list(self.endpoints)
+        allowed = set(self.endpoint_health.rank([ep.name for ep in pool]))
+        healthy = [ep for ep in pool if ep.name in allowed] or pool
+        return sorted(healthy, key=lambda ep: (ep.outstanding + 1) / ep.weight)
+
+    @contextlib.asynccontextmanager
+    async def _slot(self, model, exclude=()):
+        """模型并发位 -> 选网关并取跨进程令牌 -> 网关并发位 -> 全局并发位。
+        被退避的网关只要还有别的网关有令牌就不会干等。产出选中的 Endpoint。"""
+        async with self._model_slot(model):
+            while True:
+                shortest = None
+                for ep in self._candidates(exclude):
+                    wait = await asyncio.to_thread(self.limiter.try_acquire, self._limit_keys(ep, model))
+                    if wait <= 0: break
+                    shortest = wait if shortest is None else min(shortest, wait)
+                else:
+                    await asyncio.sleep(shortest)
+                    continue
+                break
+            ep.outstanding += 1
+            try:
+                async with ep.slots, self._global_slots:
+                    self.endpoint_health.begin(ep.name)
+                    yield ep
+            finally:
+                ep.outstanding -= 1
+
+    def _should_failover(self, endpoint, error, tried):
+        """网关级错误 (429 / 5xx / 断连) 且还有没试过的网关时，换一个网关重发"""
+        if classify_error(error) not in ("rate_limit", "server"): return False
+        tried.add(endpoint.name)
+        if len(tried) >= len(self.endpoints): return False
+        print(f"\n🌐 [网关切换] {endpoint.name} 出错 ({str(error)[:40]})，改走其它网关重试...")
+        return True
+
+    async def _report_failure(self, endpoint, model, error, latency=None, call_kind=None):
+        self.router.record_failure(model, latency=latency, kind=call_kind)
+        kind = classify_error(error)
+        if kind in ("rate_limit", "server"): self.endpoint_health.record_failure(endpoint.name)
+        else: self.endpoint_health.release(endpoint.name)
+        if kind is None: return
+        endpoint_key, model_key = [key for key, _ in self._limit_keys(endpoint, model)]
+        # 429 网关和模型一起退；5xx/断连只退网关；超时只退该模型
+        keys = {"rate_limit": [endpoint_key, model_key], "server": [endpoint_key], "timeout": [model_key]}[kind]
+        for key in keys:
+            delay = await asyncio.to_thread(self.limiter.penalize, key, kind)
+            print(f"\n🚦 [限流退避] {key} ({kind}) 本机所有进程暂停 {delay:.0f} 秒")
+
+    async def _report_success(self, endpoint, model, started, kind=None):
+        latency = time.time() - started
+        self.router.record_success(model, latency, kind)
+        self.endpoint_health.record_success(endpoint.name, latency)
+        await asyncio.to_thread(self.limiter.reward, [key for key, _ in self._limit_keys(endpoint, model)])
+
+    def _release(self, endpoint, model):
+        self.router.release(model)
+        self.endpoint_health.release(endpoint.name)
+
+    # ---------- 异步接口 (在引擎循环内使用) ----------
+
+    async def achat(self, model, messages, timeout=600, label=None, cache=False, kind=None, **params):
+        """发起一次对话请求，返回正文字符串 (timeout 为上限；给了 kind 调用类别时，实际超时按该模型这类调用的 p95 自适应)。
+        cache=True 时相同 (模型, 消息, 采样参数) 直接返回缓存结果，不占并发也不计入路由统计。"""
+        key = cache_key(model, messages, params) if cache else None
+        if key:
+            hit = await asyncio.to_thread(self.cache.get, key)
+            if hit is not None: return hit
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        tried = set()
+        try:
+            while True:
+                async with self._slot(model, exclude=tried) as endpoint:
+                    call_id = next(self._ids)
+                    started = time.time()
+                    self.inflight[call_id] = [label or model, started, 0]
+                    call_timeout = self.router.timeout_for(model, timeout, kind)
+                    self.router.begin(model)
+                    try:
+                        response = await endpoint.client.chat.completions.create(
+                            model=model, messages=messages, timeout=call_timeout, **params
+                        )
+                    except asyncio.CancelledError:
+                        self._release(endpoint, model)
+                        raise
+                    except Exception as e:
+                        latency = time.time() - started if isinstance(e, APITimeoutError) else None
+                        await self._report_failure(endpoint, model, e, latency, kind)
+                        if self._should_failover(endpoint, e, tried): continue
+                        raise
+                    finally:
+                        self.inflight.pop(call_id, None)
+                await self._report_success(endpoint, model, started, kind)
+                content = response.choices[0].message.content
+                if key and content: await asyncio.to_thread(self.cache.put, key, model, content)
+                return content
+        finally:
+            self.tasks.discard(task)
+
+    async def astream_chat(self, model, messages, stall_timeout=90, on_progress=None,
+                           progress_interval=3, timeout=1200, label=None, **params):
+        """🌊 流式请求：边收边统计字数；超过 stall_timeout 秒没有新内容即判定卡死。
+        on_progress(已收正文) 最多每 progress_interval 秒回调一次 (用于落盘断点)。
+        中途失败抛 StreamInterrupted，携带已收到的部分正文。"""
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        tried = set()
+        try:
+            while True:
+                async with self._slot(model, exclude=tried) as endpoint:
+                    call_id = next(self._ids)
+                    started = time.time()
+                    self.inflight[call_id] = [label or model, started, 0]
+                    self.router.begin(model)
+                    pieces = []
+                    stream = None
+                    last_report = started
+                    try:
+                        # 有看门狗兜底，整体超时只用调用方给的上限，不按 p95 收紧
+                        stream = await asyncio.wait_for(endpoint.client.chat.completions.create(
+                            model=model, messages=messages, timeout=timeout, stream=True, **params
+                        ), stall_timeout)
+                        chunks = stream.__aiter__()
+                        while True:
+                            remaining = timeout - (time.time() - started)
+                            if remaining <= 0: raise asyncio.TimeoutError()
+                            try:
+                                chunk = await asyncio.wait_for(chunks.__anext__(), min(stall_timeout, remaining))
+                            except StopAsyncIteration:
+                                break
+                            if not chunk.choices: continue
+                            delta = chunk.choices[0].delta.content
+                            if not delta: continue
+                            pieces.append(delta)
+                            self.inflight[call_id][2] += len(delta)
+                            if on_progress and time.time() - last_report >= progress_interval:
+                                last_report = time.time()
+                                # 回调里可能要落盘 (fsync)，放到线程里跑，别卡住共享循环上的其它请求
+                                await asyncio.to_thread(on_progress, "".join(pieces))
+                    except asyncio.CancelledError:
+                        self._release(endpoint, model)
+                        if on_progress and pieces: await asyncio.to_thread(on_progress, "".join(pieces))
+                        raise
+                    except asyncio.TimeoutError as e:
+                        await self._report_failure(endpoint, model, e)
+                        await self._close_stream(stream)
+                        waited = int(time.time() - started)
+                        raise StreamStalled(model, "".join(pieces), f"{stall_timeout} 秒无新内容 (已等 {waited} 秒)")
+                    except Exception as e:
+                        await self._report_failure(endpoint, model, e)
+                        await self._close_stream(stream)
+                        # 一个字都没收到才换网关重发；收到一半的交给调用方从断点续写
+                        if not pieces and self._should_failover(endpoint, e, tried): continue
+                        raise StreamInterrupted(model, "".join(pieces), str(e))
+                    finally:
+                        self.inflight.pop(call_id, None)
+                await self._report_success(endpoint, model, started)
+                return "".join(pieces)
+        finally:
+            self.tasks.discard(task)
+
+    async def _close_stream(self, stream):
+        if stream is None: return
+        try: await stream.close()
+        except Exception: pass
+
+    async def ahedged_chat(self, models, messages, hedge_delay=0, accept=None, fan_out=2,
+                           timeout=600, label=None, **params):
+        """🏇 对冲请求：先发给第一个模型，hedge_delay 秒后还没合格结果就追加下一个模型，
+        最多同时 fan_out 路；取第一个通过 accept 的结果并取消其余请求。返回 (模型, 正文)"""
+        accept = accept or bool
+        queue = list(models)
+        running = {}
+        last_error = None
+
+        def launch():
+            model = queue.pop(0)
+            tag = f"{label} | 🏇 {model}" if label else model
+            running[asyncio.ensure_future(self.achat(model, messages, timeout=timeout, label=tag, **params))] = model
+
+        try:
+            launch()
+            while running:
+                wait = hedge_delay if queue and len(running) < fan_out else None
+                done, _ = await asyncio.wait(running, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    launch(); continue
+                for task in done:
+                    model = running.pop(task)
+                    if task.exception() is None and accept(task.result()):
+                        return model, task.result()
+                    if task.exception() is None: self.router.record_failure(model)
+                    else: last_error = task.exception()
+                    if queue: launch()
+            raise last_error or RuntimeError("所有对冲请求均未产出合格结果")
+        finally:
+            for task in running: task.cancel()
+
+    async def _render_progress(self):
+        """🌀 唯一的进度渲染任务：定期刷新所有在途请求的等待时长"""
+        tick = 0
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            if not self.inflight: continue
+            tick += 1
+            spinner = ["|", "/", "-", "\\"][tick % 4]
+            now = time.time()
+            calls = sorted(self.inflight.values(), key=lambda c: c[1])
+            label, started, chars = calls[0]
+            elapsed = max(1, int(now - started))
+            line = f"{label} 已进行 {elapsed} 秒"
+            if chars: line += f" | 已收 {chars} 字 ({chars / elapsed:.1f} 字/秒)"
+            if len(calls) > 1: line += f" (另有 {len(calls) - 1} 个请求在途)"
+            sys.stdout.write(f"\r{spinner} [{self.progress_title}] {line}   ")
+            sys.stdout.flush()
+
+    # ---------- 同步接口 (供脚本的普通线程调用) ----------
+
+    def submit(self, model, messages, timeout=600, label=None, cache=False, **params):
+        """提交请求，立即返回 concurrent.futures.Future"""
+        if self.stopped: raise EngineStopped()
+        return self._submit(self.achat(model, messages, timeout=timeout, label=label, cache=cache, **params))
+
+    def chat(self, model, messages, timeout=600, label=None, cache=False, **params):
+        """阻塞式请求：等待结果返回正文字符串"""
+        return self._wait(self.submit(model, messages, timeout=timeout, label=label, cache=cache, **params))
+
+    def hedged_chat(self, models, messages, hedge_delay=0, accept=None, fan_out=2,
+                    timeout=600, label=None, **params):
+        """阻塞式对冲请求，返回 (模型, 正文)"""
+        if self.stopped: raise EngineStopped()
+        return self._wait(self._submit(self.ahedged_chat(
+            models, messages, hedge_delay=hedge_delay, accept=accept, fan_out=fan_out,
+            timeout=timeout, label=label, **params)))
+
+    def stream_chat(self, model, messages, stall_timeout=90, on_progress=None,
+                    progress_interval=3, timeout=1200, label=None, **params):
+        """阻塞式流式请求，返回完整正文 (中途失败抛 StreamInterrupted)"""
+        if self.stopped: raise EngineStopped()
+        return self._wait(self._submit(self.astream_chat(
+            model, messages, stall_timeout=stall_timeout, on_progress=on_progress,
+            progress_interval=progress_interval, timeout=timeout, label=label, **params)))
+
+    def _wait(self, future):
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            raise EngineStopped()
+        except KeyboardInterrupt:
+            future.cancel()
+            raise
+
+    def list_models(self):
+        """探测每个网关是否可用；全部不通时抛出最后一个异常，部分不通只打印警告"""
+        async def probe(ep):
+            try: return await ep.client.models.list()
+            except Exception as e: return e
+        async def probe_all(): return await asyncio.gather(*(probe(ep) for ep in self.endpoints))
+        results = self._submit(probe_all()).result()
+        alive = [r for r in results if not isinstance(r, Exception)]
+        if not alive: raise results[-1]
+        for ep, r in zip(self.endpoints, results):
+            if isinstance(r, Exception): print(f"⚠️ 网关 {ep.name} 连接失败: {str(r)[:60]}")
+        return alive[0]
+
+    def cancel_all(self):
+        """🛑 取消所有在途请求，之后的新请求直接抛 EngineStopped"""
+        self.stopped = True
+        self.loop.call_soon_threadsafe(self._cancel_tasks)
+
+    def _cancel_tasks(self):
+        for task in list(self.tasks): task.cancel()
+
+    def close(self):
+        self.cancel_all()
+        try:
+            self.loop.call_soon_threadsafe(self._renderer.cancel)
+            self._submit(self.http.aclose()).result(timeout=5)
+        except Exception: pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+# ==========================================
+#     🛣️ 分道输出 (多本书并行时的控制台)
+# ==========================================
+
+_LANE = threading.local()
+
+class LaneConsole:
+    """🛣️ 分道输出：并行处理多本书时按线程把输出写进各自的日志文件，控制台加前缀"""
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        lane = getattr(_LANE, "name", None)
+        if lane is None: return self.stream.write(text)
+        # 进度条用 \r 原地刷新，分道模式下统一当作换行处理
+        *lines, _LANE.buffer = (_LANE.buffer + text.replace("\r", "\n")).split("\n")
+        with self.lock:
+            for line in lines:
+                if not line.strip(): continue
+                self.stream.write(f"[{lane}] {line.rstrip()}\n")
+                if _LANE.log_file: _LANE.log_file.write(line.rstrip() + "\n")
+            self.stream.flush()
+            if _LANE.log_file: _LANE.log_file.flush()
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def enter_lane(name, log_path=None):
+    _LANE.name = name
+    _LANE.log_path = log_path
+    _LANE.buffer = ""
+    _LANE.log_file = open(log_path, "a", encoding="utf-8") if log_path else None
+
+def current_lane():
+    """供子线程 (如流水线阶段) 继承当前分道"""
+    if getattr(_LANE, "name", None) is None: return None
+    return (_LANE.name, _LANE.log_path)
+
+def leave_lane():
+    if getattr(_LANE, "name", None) is None: return
+    _LANE.name = None
+    try: _LANE.log_file.close()
+    except Exception: pass
+
+# ==========================================
+#     🧩 阶段调度 (按依赖图并发执行)
+# ==========================================
+
+class StageScheduler:
+    """🧩 阶段调度器：按依赖关系并发执行各个阶段 (章节流水线 / 开书策划共用)
+
+    submit(fn, *args, after={"参数名": future}) 会等依赖的 future 完成，
+    再把它们的结果作为同名关键字参数传给 fn；子线程继承提交者的分道。
+    """
+    def __init__(self, max_workers=4):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+
+    def submit(self, fn, *args, after=None):
+        lane = current_lane()
+        def run():
+            if lane: enter_lane(*lane)
+            try:
+                kwargs = {name: f.result() for name, f in (after or {}).items()}
+                return fn(*args, **kwargs)
+            finally: leave_lane()
+        future = self.pool.submit(run)
+        self.futures.append(future)
+        return future
+
+    def first_results(self, futures, need, spawn=None):
+        """🏁 冗余并发取前 need 个有效结果 (非 None)：先到先得，失败的由 spawn() 补一个新的顶上"""
+        pending, results = set(futures), []
+        while pending and len(results) < need:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                try: result = future.result()
+                except Exception: result = None
+                if result is not None and len(results) < need: results.append(result)
+                elif result is None and spawn: pending.add(spawn())
+        for future in pending: future.cancel()  # 还没开跑的多余阶段直接取消
+        return results
+
+    def close(self, wait=True):
+        """等所有在途阶段落盘后再退出 (否则改名归档时可能还在写 assets.txt)；wait=False 用于出错中止"""
+        self.pool.shutdown(wait=wait, cancel_futures=not wait)